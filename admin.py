@@ -8,13 +8,15 @@ from flask import redirect, request, url_for, flash, Markup
 from app import db
 from models import User, Role, Article, Tag, Discount, Product, Category, ProductImage, Order, Newsletter, Transaction, \
     Donation, WeddingRegistry, BabyShowerRegistry, BridalShowerRegistry, BirthdayRegistry, ProductBundleItem
-from slugify import UniqueSlugify, Slugify
+from slugify import Slugify
 from wtforms import TextAreaField, FileField, FloatField
 from flask_admin.actions import action
 from forms import DiscountForm, ArticleForm
 from utils import get_file_path, date_format, generate_folder_name, get_relative_file_path, generate_random_string
 from flask_admin.model.form import InlineFormAdmin
 from flask_admin.model import typefmt
+from instrumentation import sql_instrumentation
+from payment import stats as paystack_stats, processed_references
 
 
 MY_DEFAULT_FORMATTERS = dict(typefmt.BASE_FORMATTERS)
@@ -32,9 +34,15 @@ def strip_html_tags(view, context, model, name):
     return ''
 
 
-# Create customized model view class
-class MyModelView(sqla.ModelView):
-    column_type_formatters = MY_DEFAULT_FORMATTERS
+def assign_slug(model, field):
+    """Allocate a slug from field when the record is new or field was edited"""
+    if not model.slug or db.inspect(model).attrs[field].history.has_changes():
+        slugify = Slugify(to_lower=True)
+        model.allocate_slug(slugify(getattr(model, field)))
+
+
+class SuperuserAccessMixin(object):
+    """Restrict an admin view to active superusers"""
 
     def is_accessible(self):
         if not current_user.is_active or not current_user.is_authenticated:
@@ -57,6 +65,11 @@ class MyModelView(sqla.ModelView):
             flash("You are not authorized to access this page", 'error')
             return redirect(url_for('security.login', next=request.url))
 
+
+# Create customized model view class
+class MyModelView(SuperuserAccessMixin, sqla.ModelView):
+    column_type_formatters = MY_DEFAULT_FORMATTERS
+
     # can_edit = True
     edit_modal = True
     create_modal = True
@@ -135,6 +148,22 @@ class CustomView(MyModelView):
         return self.render('admin/custom_index.html')
 
 
+class QueryStatsView(SuperuserAccessMixin, BaseView):
+    @expose('/')
+    def index(self):
+        return self.render('admin/query_stats.html', stats=sql_instrumentation.snapshot(),
+                           threshold=sql_instrumentation.threshold, pools=db.pool_stats(),
+                           paystack=sorted(paystack_stats.items()), dedupe=processed_references)
+
+    @expose('/reset', methods=['POST'])
+    def reset(self):
+        sql_instrumentation.reset()
+        paystack_stats.clear()
+        processed_references.reset()
+        flash('Query statistics have been reset', 'success')
+        return redirect(url_for('.index'))
+
+
 class TagView(MyModelView):
     column_list = ['name', 'slug', 'created_by', 'date_created']
     form_excluded_columns = ['slug', 'created_by', 'date_created', 'posts']
@@ -142,11 +171,7 @@ class TagView(MyModelView):
     def on_model_change(self, form, model, is_created):
         if is_created:
             model.created_by = current_user
-            unique_slug = UniqueSlugify(to_lower=True)
-            model.slug = unique_slug(model.name)
-        else:
-            slug = Slugify(to_lower=True)
-            model.slug = slug(model.name)
+        assign_slug(model, 'name')
 
 
 class ArticleView(MyModelView):
@@ -183,11 +208,7 @@ class ArticleView(MyModelView):
     def on_model_change(self, form, model, is_created):
         if is_created:
             model.created_by = current_user
-            unique_slug = UniqueSlugify(to_lower=True)
-            model.slug = unique_slug(model.title)
-        else:
-            slug = Slugify(to_lower=True)
-            model.slug = slug(model.title)
+        assign_slug(model, 'title')
 
     @action('publish', 'Mark as Published', 'Are you sure you want to publish selected articles?')
     def action_publish(self, ids):
@@ -265,11 +286,7 @@ class ProductCategoryView(MyModelView):
     def on_model_change(self, form, model, is_created):
         if is_created:
             model.created_by = current_user
-            unique_slug = UniqueSlugify(to_lower=True)
-            model.slug = unique_slug(model.name)
-        else:
-            slug = Slugify(to_lower=True)
-            model.slug = slug(model.name)
+        assign_slug(model, 'name')
 
 
 class ProductImageInlineForm(InlineFormAdmin):
@@ -323,12 +340,8 @@ class ProductBundleView(MyModelView):
     def on_model_change(self, form, model, is_created):
         if is_created:
             model.created_by = current_user
-            unique_slug = UniqueSlugify(to_lower=True)
-            model.slug = unique_slug(model.name)
             model.is_bundle = True
-        else:
-            slug = Slugify(to_lower=True)
-            model.slug = slug(model.name)
+        assign_slug(model, 'name')
 
     @action('unavailable', 'Mark as Unavailable', 'Are you sure you want to mark these items as Out of Stock?')
     def action_unavailable(self, ids):
@@ -379,11 +392,7 @@ class ProductView(MyModelView):
     def on_model_change(self, form, model, is_created):
         if is_created:
             model.created_by = current_user
-            unique_slug = UniqueSlugify(to_lower=True)
-            model.slug = unique_slug(model.name)
-        else:
-            slug = Slugify(to_lower=True)
-            model.slug = slug(model.name)
+        assign_slug(model, 'name')
 
     def get_query(self):
         return super(ProductView, self).get_query().filter(Product.is_bundle.is_(False))
@@ -559,3 +568,5 @@ admin.add_view(DonationView(Donation, db.session, menu_icon_type='fa', menu_icon
                             name='Honeymoon Funds'))
 admin.add_view(TransactionView(Transaction, db.session, menu_icon_type='fa', menu_icon_value='fa-credit-card',
                                name='Transactions'))
+admin.add_view(QueryStatsView(name='Query Stats', endpoint='query-stats', menu_icon_type='fa',
+                              menu_icon_value='fa-database'))
@@ -4,6 +4,10 @@ from flask import Flask, url_for
 from flask_admin import helpers as admin_helpers
 from flask_migrate import Migrate
 from database import db
+from cache import model_cache
+from instrumentation import sql_instrumentation
+from cart import cart_store
+from payment import processed_references
 from flask_ckeditor import CKEditor
 from frontend import frontend
 
@@ -13,6 +17,10 @@ app = Flask(__name__)
 app.config.from_pyfile('config.py')
 # db = SQLAlchemy(app)
 db.init_app(app)
+model_cache.init_app(app)
+sql_instrumentation.init_app(app)
+cart_store.init_app(app)
+processed_references.init_app(app)
 migrate = Migrate(app, db)
 ckeditor = CKEditor(app)
 
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Read-through cache for model lookups by id and slug."""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+
+class LRUCache(object):
+    """In-process least-recently-used cache whose entries expire after ``ttl`` seconds.
+
+    Any object with the same ``get``, ``set``, ``delete`` and ``delete_prefix`` methods
+    can be used as a ``ModelCache`` backend instead.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [x for x in self._data if x.startswith(prefix)]:
+                del self._data[key]
+
+
+class BloomFilter(object):
+    """Set membership test in a fixed amount of memory.
+
+    ``value in bloom`` is never False for an added value, and wrongly True for about
+    ``error_rate`` of other values once ``capacity`` values have been added.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        with self._lock:
+            for position in self._positions(value):
+                self._bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, value):
+        return all(self._bits[position // 8] & (1 << (position % 8)) for position in self._positions(value))
+
+
+class ModelCache(object):
+    """Caches the column values of records looked up by id or slug.
+
+    Only models with ``cache_lookups = True`` are cached. Hits are rebuilt as persistent
+    instances attached to the current session, so relationships still lazy load.
+    """
+
+    def __init__(self, app=None, backend=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app, backend)
+
+    def init_app(self, app, backend=None):
+        if not app.config.get('MODEL_CACHE_ENABLED', True):
+            self.backend = None
+            return
+        self.backend = backend or LRUCache(maxsize=app.config.get('MODEL_CACHE_SIZE', 10000),
+                                           ttl=app.config.get('MODEL_CACHE_TTL', 60))
+
+    def is_cached(self, model):
+        return self.backend is not None and getattr(model, 'cache_lookups', False)
+
+    @staticmethod
+    def key(model, field, value):
+        return f"{model.__tablename__}:{field}:{value}"
+
+    def lookup(self, session, model, field, value, loader):
+        """Return the record of ``model`` whose ``field`` equals ``value``, calling ``loader`` on a miss."""
+        if not self.is_cached(model):
+            return loader()
+
+        key = self.key(model, field, value)
+        values = self.backend.get(key)
+        if values is not None:
+            return self.restore(session, model, values)
+
+        instance = loader()
+        # a replica may lag behind the primary, and a stale copy would outlive the lag
+        if instance is not None and not self.reads_replica(session):
+            self.backend.set(key, self.snapshot(instance))
+        return instance
+
+    @staticmethod
+    def reads_replica(session):
+        """Whether the session sends its reads to a read replica"""
+        use_replica = getattr(session, 'use_replica', None)
+        return bool(use_replica and use_replica())
+
+    @staticmethod
+    def snapshot(instance):
+        state = inspect(instance)
+        return {attr.key: state.dict[attr.key] for attr in state.mapper.column_attrs if attr.key in state.dict}
+
+    @staticmethod
+    def restore(session, model, values):
+        instance = model.__mapper__.class_manager.new_instance()
+        for key, value in values.items():
+            set_committed_value(instance, key, value)
+        make_transient_to_detached(instance)
+        return session.merge(instance, load=False)
+
+    def keys_for(self, instance):
+        """Every cache key that may hold ``instance``, including its previous slug."""
+        model = instance.__class__
+        state = inspect(instance)
+        keys = set()
+        if state.identity:
+            keys.add(self.key(model, 'id', state.identity[0]))
+        if 'slug' in state.mapper.column_attrs:
+            history = state.attrs.slug.history
+            for slug in history.sum():
+                keys.add(self.key(model, 'slug', slug))
+        return keys
+
+    def invalidate(self, keys):
+        if self.backend is None:
+            return
+        for key in keys:
+            self.backend.delete(key)
+
+    def invalidate_model(self, model):
+        if self.is_cached(model):
+            self.backend.delete_prefix(f"{model.__tablename__}:")
+
+
+model_cache = ModelCache()
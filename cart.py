@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Server-side cart store.
+
+The session only holds the cart id and copies of the cart totals shown in the header. Lines (registry product id
+and quantity) live in the ``cart_items`` table, and product display data is joined in when the cart is rendered.
+"""
+from collections import OrderedDict
+from flask import session
+from sqlalchemy.orm import joinedload
+from cache import LRUCache
+from database import db, unit_of_work
+from models import Cart, CartItem, RegistryProducts, RegistryBase
+
+
+class CartStore(object):
+    """Reads and edits the cart of the current session.
+
+    Rendered carts are cached per worker under the cart id and the ``Cart.version`` read
+    from the database, which every edit bumps while it holds the cart's row lock, so
+    every page showing the header cart costs one primary key lookup and an edit made
+    through another worker or request is never served stale.
+    """
+
+    def __init__(self, app=None):
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('CART_CACHE_ENABLED', True):
+            self.cache = LRUCache(maxsize=app.config.get('CART_CACHE_SIZE', 10000),
+                                  ttl=app.config.get('CART_CACHE_TTL', 300))
+
+    @staticmethod
+    def cart_id():
+        return session.get('cart_id')
+
+    def cart(self, create=False):
+        """The Cart of the session, created on first use when create is True"""
+        cart = Cart.query.get(self.cart_id()) if self.cart_id() else None
+        if cart is None and create:
+            cart = Cart()
+            cart.save()
+            session['cart_id'] = cart.id
+        return cart
+
+    def add(self, registry_product, quantity=1):
+        """Add quantity of a registry product to the cart at its current price"""
+        with unit_of_work():
+            cart = self.cart(create=True)
+            cart.add(registry_product.id, registry_product.product.price, quantity)
+        self.changed(cart)
+
+    def remove(self, reg_product_id):
+        cart = self.cart()
+        if cart:
+            cart.remove(reg_product_id)
+            db.session.commit()
+            self.changed(cart)
+
+    def apply_discount(self, discount):
+        cart = self.cart()
+        if cart:
+            cart.apply_discount(discount)
+            db.session.commit()
+            self.changed(cart)
+
+    def clear(self):
+        cart = self.cart()
+        session.pop('cart_id', None)
+        if cart:
+            cart.delete()
+
+    @staticmethod
+    def changed(cart):
+        """Copy the totals shown on every page into the session"""
+        session['all_total_quantity'] = cart.total_quantity
+        session['all_total_price'] = cart.total_price
+        session['discount_id'] = cart.discount_id
+        session['discount_amount'] = cart.discount_amount
+        session['discounted_price'] = cart.discounted_price
+
+    def items(self):
+        """Cart lines keyed by registry product id, with their product and registry display data"""
+        cart_id = self.cart_id()
+        if not cart_id:
+            return OrderedDict()
+
+        version = db.session.query(Cart.version).filter_by(id=cart_id).scalar()
+        if version is None:
+            return OrderedDict()
+
+        key = f"{cart_id}:{version}"
+        items = self.cache.get(key) if self.cache is not None else None
+        if items is None:
+            items = self.load(cart_id)
+            if self.cache is not None:
+                self.cache.set(key, items)
+        return items
+
+    def summary(self):
+        """The cart totals and lines as returned by the JSON cart endpoints.
+
+        Both are read while holding the cart's row lock, so the totals always add up to
+        the lines, even while another request is editing the cart.
+        """
+        cart = self.cart()
+        if cart is None:
+            return {'total_quantity': 0, 'total_price': 0, 'discount_amount': 0, 'discounted_price': 0, 'items': []}
+
+        with unit_of_work():
+            cart.lock()
+            summary = {
+                'total_quantity': cart.total_quantity,
+                'total_price': cart.total_price,
+                'discount_amount': cart.discount_amount,
+                'discounted_price': cart.discounted_price,
+                'items': [dict(value, reg_product_id=int(key)) for key, value in self.load(cart.id).items()],
+            }
+        return summary
+
+    @staticmethod
+    def load(cart_id):
+        lines = CartItem.query.filter_by(cart_id=cart_id).order_by(CartItem.id).all()
+        products = {x.id: x for x in RegistryProducts.query.options(joinedload(RegistryProducts.product)).
+                    filter(RegistryProducts.id.in_([x.reg_product_id for x in lines]))} if lines else {}
+
+        # one query per registry type in the cart
+        ids = {}
+        for product in products.values():
+            ids.setdefault(product.registry_type, set()).add(product.registry_id)
+        registries = {}
+        for registry_type, registry_ids in ids.items():
+            model = RegistryBase.for_type_code(registry_type)
+            for registry in model.query.filter(model.id.in_(registry_ids)):
+                registries[(registry_type, registry.id)] = registry
+
+        items = OrderedDict()
+        for line in lines:
+            product = products.get(line.reg_product_id)
+            registry = product and registries.get((product.registry_type, product.registry_id))
+            if not registry:
+                continue
+            items[str(line.reg_product_id)] = {
+                'quantity': line.quantity,
+                'unit_price': line.unit_price,
+                'total_price': line.quantity * line.unit_price,
+                # only what the cart templates and API render, not the product description
+                'product': {'id': product.product_id, 'name': product.product.name, 'price': product.product.price,
+                            'image': product.product.main_image_path, 'slug': product.product.slug},
+                'registry_id': product.registry_id,
+                'registry_type': product.registry_type,
+                'registry': {'id': registry.id, 'name': registry.name, 'url': registry.url, 'slug': registry.slug},
+            }
+        return items
+
+
+cart_store = CartStore()
@@ -0,0 +1,92 @@
+from database import db, unit_of_work
+from models import Transaction, Order, OrderItem, CartItem, RegistryProducts, Product
+
+
+def revalidate_cart(cart):
+    """Check every line of a cart against the current product prices and availability.
+
+    The lines, their registry products and products are loaded in a single query.
+    Lines whose product was removed, is unavailable or was already bought from the
+    registry are dropped and changed prices are applied to the cart, whose totals are
+    then rebuilt from the verified lines. Returns the verified lines, keyed by registry
+    product id as create_order_transaction expects, and a message for every line that
+    changed and for a discount that no longer applies.
+    """
+    cart.lock()
+    discount = cart.discount
+    rows = db.session.query(CartItem, RegistryProducts, Product).\
+        outerjoin(RegistryProducts, RegistryProducts.id == CartItem.reg_product_id).\
+        outerjoin(Product, Product.id == RegistryProducts.product_id).\
+        filter(CartItem.cart_id == cart.id).order_by(CartItem.id).all()
+
+    items = {}
+    changes = []
+    for line, registry_product, product in rows:
+        if product is None or not product.is_available:
+            name = product.name if product else 'An item'
+            changes.append(f'{name} is no longer available and has been removed from your cart')
+            cart.remove_line(line)
+            continue
+        if registry_product.has_been_purchased:
+            changes.append(f'{product.name} has already been bought from the registry and has been removed '
+                           f'from your cart')
+            cart.remove_line(line)
+            continue
+        if product.price != line.unit_price:
+            changes.append(f'The price of {product.name} has changed to {product.price:,.2f}')
+            cart.reprice_line(line, product.price)
+        items[str(line.reg_product_id)] = {
+            'quantity': line.quantity, 'unit_price': product.price, 'total_price': line.quantity * product.price,
+            'registry_id': registry_product.registry_id, 'registry_type': registry_product.registry_type,
+        }
+
+    # lines deleted without going through the cart never reached the running totals
+    total_quantity = sum(x['quantity'] for x in items.values())
+    if total_quantity != cart.total_quantity:
+        cart.version += 1
+        if not changes:
+            changes.append('Some items are no longer available and have been removed from your cart')
+    cart.total_quantity = total_quantity
+    cart.total_price = round(sum(x['total_price'] for x in items.values()), 2)
+    cart.recalculate_discount()
+    if discount is not None and cart.discount is None:
+        changes.append(f'The discount code {discount.code} is no longer valid and has been removed')
+    return items, changes
+
+
+def create_order_transaction(form, cart_items, total_amount, discount_id=None, discounted_amount=None):
+    """Create the transaction, its orders and order items for a cart in a single commit.
+
+    Cart lines are grouped by (registry_type, registry_id) in memory, so each registry
+    gets one order without querying for orders created earlier in the same checkout.
+    Transaction and order numbers are allocated up front, so every row is inserted once.
+    """
+    tran = Transaction()
+    form.populate_obj(tran)
+    tran.type = 'order'
+    tran.total_amount = total_amount
+    tran.payment_status = 'unpaid'
+    tran.generate_txn_number()
+    if discount_id:
+        tran.discount_id = discount_id
+        tran.discounted_amount = discounted_amount
+
+    orders = {}
+    items = []
+    for key, product in cart_items.items():
+        group = (product['registry_type'], product['registry_id'])
+        order = orders.get(group)
+
+        if not order:
+            order = Order(registry_type=product['registry_type'], registry_id=product['registry_id'],
+                          transaction=tran, status='pending')
+            order.generate_order_number()
+            orders[group] = order
+
+        items.append(OrderItem(order=order, reg_product_id=key, quantity=product['quantity'],
+                               unit_price=product['unit_price'], total_price=product['total_price']))
+
+    with unit_of_work() as session:
+        session.add(tran)
+        session.add_all(items)
+    return tran
@@ -8,6 +8,83 @@ SECRET_KEY = os.getenv('SECRET_KEY')
 SQLALCHEMY_ECHO = False
 SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI')
 
+# Connection pool settings, per engine and per worker process. Size, overflow and
+# timeout only apply to pooled (non SQLite) databases, so they are only set when given.
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_pre_ping': os.getenv('SQLALCHEMY_POOL_PRE_PING', 'True').lower() in ('true', '1'),
+    'pool_recycle': int(os.getenv('SQLALCHEMY_POOL_RECYCLE', 3600)),
+}
+for _option, _variable in (('pool_size', 'SQLALCHEMY_POOL_SIZE'), ('max_overflow', 'SQLALCHEMY_MAX_OVERFLOW'),
+                           ('pool_timeout', 'SQLALCHEMY_POOL_TIMEOUT')):
+    if os.getenv(_variable):
+        SQLALCHEMY_ENGINE_OPTIONS[_option] = int(os.getenv(_variable))
+
+# Optional read replica used by views decorated with replica_reads
+SQLALCHEMY_BINDS = {'replica': os.getenv('SQLALCHEMY_REPLICA_URI')} if os.getenv('SQLALCHEMY_REPLICA_URI') else {}
+# Seconds a client keeps reading from the primary after it writes
+SQLALCHEMY_REPLICA_STICKY_SECONDS = int(os.getenv('SQLALCHEMY_REPLICA_STICKY_SECONDS', 10))
+
+# Number of registries shown per page on the public listings
+REGISTRIES_PER_PAGE = int(os.getenv('REGISTRIES_PER_PAGE', 20))
+
+
+# Read-through cache for get_by_id/get_by_slug lookups of models with cache_lookups = True
+MODEL_CACHE_ENABLED = os.getenv('MODEL_CACHE_ENABLED', 'True').lower() in ('true', '1')
+MODEL_CACHE_SIZE = int(os.getenv('MODEL_CACHE_SIZE', 10000))
+MODEL_CACHE_TTL = int(os.getenv('MODEL_CACHE_TTL', 60))
+
+# Per-request SQL statement counts, Server-Timing header and N+1 warnings
+SQL_INSTRUMENTATION = os.getenv('SQL_INSTRUMENTATION', 'True').lower() in ('true', '1')
+SQL_REPEAT_WARNING_THRESHOLD = int(os.getenv('SQL_REPEAT_WARNING_THRESHOLD', 10))
+
+# Per-worker cache of rendered carts, keyed by cart id and version
+CART_CACHE_ENABLED = os.getenv('CART_CACHE_ENABLED', 'True').lower() in ('true', '1')
+CART_CACHE_SIZE = int(os.getenv('CART_CACHE_SIZE', 10000))
+CART_CACHE_TTL = int(os.getenv('CART_CACHE_TTL', 300))
+# Largest quantity a single request may add to the cart
+CART_MAX_QUANTITY = int(os.getenv('CART_MAX_QUANTITY', 100))
+# Carts not updated for this many days are deleted by `manage.py purge_carts`
+CART_RETENTION_DAYS = int(os.getenv('CART_RETENTION_DAYS', 30))
+
+# Transaction and order numbers each worker reserves per round trip to number_blocks
+NUMBER_BLOCK_SIZE = int(os.getenv('NUMBER_BLOCK_SIZE', 100))
+
+# Remember taken slugs per table in memory, so creates skip candidates known to conflict
+SLUG_BLOOM_FILTER = os.getenv('SLUG_BLOOM_FILTER', 'False').lower() in ('true', '1')
+SLUG_BLOOM_FILTER_CAPACITY = int(os.getenv('SLUG_BLOOM_FILTER_CAPACITY', 100000))
+
+# Paystack API. Calls share a keep-alive connection pool per worker; connect errors are
+# retried for every call, timeouts and 5xx responses only for transaction verification.
+PAYSTACK_BASE_URL = os.getenv('PAYSTACK_BASE_URL', 'https://api.paystack.co')
+PAYSTACK_SECRET_KEY = os.getenv('PAYSTACK_SECRET_KEY')
+# currency of our transactions, checked on charge.success webhooks
+PAYSTACK_CURRENCY = os.getenv('PAYSTACK_CURRENCY', 'NGN')
+PAYSTACK_CONNECT_TIMEOUT = float(os.getenv('PAYSTACK_CONNECT_TIMEOUT', 3.05))
+PAYSTACK_READ_TIMEOUT = float(os.getenv('PAYSTACK_READ_TIMEOUT', 10))
+PAYSTACK_POOL_SIZE = int(os.getenv('PAYSTACK_POOL_SIZE', 10))
+PAYSTACK_MAX_RETRIES = int(os.getenv('PAYSTACK_MAX_RETRIES', 3))
+PAYSTACK_RETRY_BACKOFF = float(os.getenv('PAYSTACK_RETRY_BACKOFF', 0.3))
+
+# `manage.py verify_payments`: worker threads, events fetched per poll, and retries of
+# references Paystack could not confirm, backing off exponentially from PAYMENT_RETRY_BACKOFF
+# seconds. An event claimed by a worker that dies is retried after PAYMENT_EVENT_LEASE seconds.
+PAYMENT_WORKERS = int(os.getenv('PAYMENT_WORKERS', 4))
+PAYMENT_BATCH_SIZE = int(os.getenv('PAYMENT_BATCH_SIZE', 100))
+PAYMENT_POLL_INTERVAL = float(os.getenv('PAYMENT_POLL_INTERVAL', 2))
+PAYMENT_MAX_ATTEMPTS = int(os.getenv('PAYMENT_MAX_ATTEMPTS', 8))
+PAYMENT_RETRY_BACKOFF = int(os.getenv('PAYMENT_RETRY_BACKOFF', 30))
+PAYMENT_MAX_RETRY_BACKOFF = int(os.getenv('PAYMENT_MAX_RETRY_BACKOFF', 3600))
+PAYMENT_EVENT_LEASE = int(os.getenv('PAYMENT_EVENT_LEASE', 300))
+
+# Payment references already marked paid are remembered per worker for this many seconds,
+# so duplicate webhooks and callbacks are answered without touching the database
+PAYMENT_DEDUPE_CACHE_ENABLED = os.getenv('PAYMENT_DEDUPE_CACHE_ENABLED', 'True').lower() in ('true', '1')
+PAYMENT_DEDUPE_CACHE_SIZE = int(os.getenv('PAYMENT_DEDUPE_CACHE_SIZE', 10000))
+PAYMENT_DEDUPE_CACHE_TTL = int(os.getenv('PAYMENT_DEDUPE_CACHE_TTL', 300))
+
+# `manage.py reconcile`: unpaid transactions at least this old are verified with Paystack
+RECONCILE_MIN_AGE_MINUTES = int(os.getenv('RECONCILE_MIN_AGE_MINUTES', 60))
+RECONCILE_BATCH_SIZE = int(os.getenv('RECONCILE_BATCH_SIZE', 500))
 
 # Flask-Security config
 SECURITY_URL_PREFIX = "/admin"
@@ -1,10 +1,122 @@
 # -*- coding: utf-8 -*-
 """Database module, including the SQLAlchemy database object and DB-related utilities."""
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event, and_
+import base64
+import datetime as dt
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request, session as cookie_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, and_, or_, orm, exc, select, inspect, UniqueConstraint
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import remote, foreign, backref
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from cache import model_cache, BloomFilter
+from instrumentation import Histogram
 
-db = SQLAlchemy()
+# name of the SQLALCHEMY_BINDS entry of the read replica
+REPLICA_BIND = 'replica'
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads to the read replica in views decorated with ``replica_reads``.
+
+    Flushes, bulk updates, units of work and requests shortly after this client
+    wrote something (read-your-writes) always use the primary.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_replica(clause):
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def use_replica(self, clause=None):
+        if self._flushing or self.info.get('unit_of_work') or isinstance(clause, UpdateBase):
+            return False
+        if not has_request_context() or not g.get('replica_reads') or request.method != 'GET':
+            return False
+        if REPLICA_BIND not in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+            return False
+        return cookie_session.get('db_primary_until', 0) < time.time()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection and how
+    long connections are held before being returned.
+
+    Pool events fire only once a connection has been handed out, so the wait
+    is timed around the pool's own checkout instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self.wait_times = Histogram()
+        self.hold_times = Histogram()
+        self.timeouts = 0
+        self.peak_checked_out = 0
+        event.listen(self, 'checkout', self.on_checkout)
+        event.listen(self, 'checkin', self.on_checkin)
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['checked_out_at'] = time.perf_counter()
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop('checked_out_at', None)
+        if checked_out_at is not None:
+            self.hold_times.observe(time.perf_counter() - checked_out_at)
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.wait_times.observe(time.perf_counter() - started)
+        self.peak_checked_out = max(self.peak_checked_out, self.checkedout())
+        return connection
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with replica-aware sessions and instrumented connection pools."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(RoutingSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        # SQLite gets a Static/NullPool from Flask-SQLAlchemy; everything else pools connections
+        options.setdefault('poolclass', InstrumentedQueuePool)
+
+    def pool_stats(self, app=None):
+        """Current state of the connection pool of each bind, as (bind, pool) pairs."""
+        app = self.get_app(app)
+        binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or {})
+        pools = [(bind or 'primary', self.get_engine(app, bind=bind).pool) for bind in binds]
+        return [(bind, pool) for bind, pool in pools if isinstance(pool, InstrumentedQueuePool)]
+
+    def init_app(self, app):
+        super(RoutingSQLAlchemy, self).init_app(app)
+        app.after_request(stick_to_primary)
+
+
+def stick_to_primary(response):
+    """Keep a client on the primary for a while after it writes, so it reads its own writes."""
+    if g.get('db_wrote'):
+        cookie_session['db_primary_until'] = time.time() + current_app.config.get('SQLALCHEMY_REPLICA_STICKY_SECONDS', 10)
+    return response
+
+
+db = RoutingSQLAlchemy()
 
 # Alias common SQLAlchemy names
 Column = db.Column
@@ -13,6 +125,113 @@ relationship = db.relationship
 # base string
 basestring = (str, bytes)
 
+# A page of keyset-paginated records and the cursors of its neighbours
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+
+def encode_cursor(record):
+    """Encode the (date_created, id) position of a record as an opaque cursor."""
+    value = f"{record.date_created.isoformat()}|{record.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into (date_created, id). Returns None for invalid cursors."""
+    try:
+        date_created, record_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return dt.datetime.fromisoformat(date_created), int(record_id)
+    except (ValueError, UnicodeError):
+        return None
+
+
+@contextmanager
+def unit_of_work():
+    """Group writes into a single database commit.
+
+    Inside the block ``save``, ``delete``, ``bulk_create`` and ``bulk_update`` flush
+    instead of committing, and the session is committed once when the outermost
+    block exits (or rolled back if it raises).
+
+    Usage: ::
+
+        with unit_of_work():
+            order.save()
+            OrderItem.bulk_create(rows)
+    """
+    session = db.session
+    depth = session.info.get('unit_of_work', 0)
+    session.info['unit_of_work'] = depth + 1
+    try:
+        yield session
+    except Exception:
+        session.info['unit_of_work'] = depth
+        if not depth:
+            session.rollback()
+        raise
+    session.info['unit_of_work'] = depth
+    if not depth:
+        session.commit()
+
+
+def commit_session():
+    """Commit the session, or only flush it when inside a unit of work."""
+    if db.session.info.get('unit_of_work'):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+# Blocks of numbers reserved by NumberAllocator, one row per sequence name
+number_blocks = db.Table(
+    'number_blocks',
+    db.Column('name', db.String(50), primary_key=True),
+    db.Column('next_value', db.BigInteger, nullable=False),
+)
+
+
+class NumberAllocator(object):
+    """Hands out increasing numbers per sequence name without a round trip per number.
+
+    Each worker reserves a block of NUMBER_BLOCK_SIZE numbers at a time (hi/lo), by
+    bumping its ``number_blocks`` row in a short transaction of its own, and serves
+    numbers from the block in memory. Numbers are unique across workers but not
+    gapless: whatever is left of a block is skipped when the worker exits.
+    """
+
+    def __init__(self):
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def next(self, name):
+        with self._lock:
+            current, end = self._blocks.get(name, (0, 0))
+            if current >= end:
+                current, end = self._reserve(name)
+            self._blocks[name] = (current + 1, end)
+            return current
+
+    def _reserve(self, name):
+        """Reserve the next block of name, returning its (first, end) numbers"""
+        size = current_app.config.get('NUMBER_BLOCK_SIZE', 100)
+        table = number_blocks
+        for attempt in range(2):
+            try:
+                with db.engine.begin() as connection:
+                    updated = connection.execute(table.update().where(table.c.name == name).
+                                                 values(next_value=table.c.next_value + size)).rowcount
+                    if updated:
+                        end = connection.execute(select([table.c.next_value]).where(table.c.name == name)).scalar()
+                        return end - size, end
+                    connection.execute(table.insert().values(name=name, next_value=1 + size))
+                    return 1, 1 + size
+            except IntegrityError:
+                # another worker created the row first, bump it instead
+                if attempt:
+                    raise
+
+
+number_allocator = NumberAllocator()
+
 
 class CRUDMixin(object):
     """Mixin that adds convenience methods for CRUD (create, read, update, delete) operations."""
@@ -23,6 +242,25 @@ class CRUDMixin(object):
         instance = cls(**kwargs)
         return instance.save()
 
+    @classmethod
+    def bulk_create(cls, rows, commit=True, return_defaults=False):
+        """Insert many records from a list of dicts using a single executemany.
+
+        Set ``return_defaults`` to populate generated primary keys back into the dicts.
+        """
+        db.session.bulk_insert_mappings(cls, rows, return_defaults=return_defaults)
+        if commit:
+            commit_session()
+        return rows
+
+    @classmethod
+    def bulk_update(cls, rows, commit=True):
+        """Update many records from a list of dicts, each including its primary key."""
+        db.session.bulk_update_mappings(cls, rows)
+        if commit:
+            commit_session()
+        return rows
+
     def update(self, commit=True, **kwargs):
         """Update specific fields of a record."""
         for attr, value in kwargs.items():
@@ -33,13 +271,13 @@ class CRUDMixin(object):
         """Save the record."""
         db.session.add(self)
         if commit:
-            db.session.commit()
+            commit_session()
         return self
 
     def delete(self, commit=True):
         """Remove the record from the database."""
         db.session.delete(self)
-        return commit and db.session.commit()
+        return commit and commit_session()
 
 
 class Model(CRUDMixin, db.Model):
@@ -66,7 +304,8 @@ class SurrogatePK(object):
                 isinstance(record_id, (int, float)),
             )
         ):
-            return cls.query.get(int(record_id))
+            record_id = int(record_id)
+            return model_cache.lookup(db.session(), cls, 'id', record_id, lambda: cls.query.get(record_id))
         return None
 
 
@@ -77,7 +316,7 @@ class CustomModelMixin(SurrogatePK):
     def get_by_slug(cls, slug):
         """Get record by slug"""
         if hasattr(cls, 'slug'):
-            return cls.query.filter_by(slug=slug).first()
+            return model_cache.lookup(db.session(), cls, 'slug', slug, lambda: cls.query.filter_by(slug=slug).first())
         return None
 
     @classmethod
@@ -87,6 +326,163 @@ class CustomModelMixin(SurrogatePK):
             return cls.query.filter_by(is_active=True).all()
         return None
 
+    @classmethod
+    def get_active_page(cls, after=None, before=None, per_page=20):
+        """Get a page of active records, newest first, using keyset pagination on (date_created, id).
+
+        Pass the ``next_cursor`` of a page as ``after`` to get the following page,
+        or its ``prev_cursor`` as ``before`` to get the preceding one.
+        """
+        if not hasattr(cls, 'is_active'):
+            return None
+        query = cls.query.filter_by(is_active=True)
+        position = decode_cursor(before or after) if (before or after) else None
+
+        if position and before:
+            date_created, record_id = position
+            query = query.filter(or_(cls.date_created > date_created,
+                                     and_(cls.date_created == date_created, cls.id > record_id)))
+            items = query.order_by(cls.date_created.asc(), cls.id.asc()).limit(per_page + 1).all()
+            has_more = len(items) > per_page
+            items = list(reversed(items[:per_page]))
+            return Page(items=items,
+                        next_cursor=encode_cursor(items[-1]) if items else None,
+                        prev_cursor=encode_cursor(items[0]) if items and has_more else None)
+
+        if position:
+            date_created, record_id = position
+            query = query.filter(or_(cls.date_created < date_created,
+                                     and_(cls.date_created == date_created, cls.id < record_id)))
+        items = query.order_by(cls.date_created.desc(), cls.id.desc()).limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        return Page(items=items,
+                    next_cursor=encode_cursor(items[-1]) if items and has_more else None,
+                    prev_cursor=encode_cursor(items[0]) if items and position else None)
+
+
+# bloom filters of taken slugs, per table
+_slug_filters = {}
+_slug_filters_lock = threading.Lock()
+
+
+class UniqueSlugMixin(object):
+    """Mixin for models whose ``slug`` column has a unique index.
+
+    ``allocate_slug`` claims a slug by writing the row inside a SAVEPOINT and letting the
+    unique index reject duplicates, retrying with a random suffix on conflict, so no
+    SELECT is needed to check the slug first. With SLUG_BLOOM_FILTER enabled, slugs
+    known to be taken in this process skip straight to a suffixed candidate.
+    """
+
+    slug_attempts = 5
+
+    @classmethod
+    def taken_slugs(cls):
+        """Bloom filter of the slugs of this table, loaded on first use, or None when disabled"""
+        if not current_app.config.get('SLUG_BLOOM_FILTER'):
+            return None
+        table = cls.__tablename__
+        with _slug_filters_lock:
+            if table not in _slug_filters:
+                bloom = BloomFilter(current_app.config.get('SLUG_BLOOM_FILTER_CAPACITY', 100000))
+                with db.session.no_autoflush:
+                    for slug, in db.session.query(cls.slug).filter(cls.slug.isnot(None)).yield_per(1000):
+                        bloom.add(slug)
+                _slug_filters[table] = bloom
+            return _slug_filters[table]
+
+    @classmethod
+    def is_slug_collision(cls, error):
+        """Whether an IntegrityError was raised by the unique index on slug, rather than another constraint"""
+        table = cls.__table__
+        names = {x.name for x in table.indexes if x.unique and [c.name for c in x.columns] == ['slug']}
+        names |= {x.name for x in table.constraints
+                  if isinstance(x, UniqueConstraint) and [c.name for c in x.columns] == ['slug']}
+        # an unnamed unique constraint is named after its column by MySQL
+        names = {x or 'slug' for x in names}
+        constraint = getattr(getattr(error.orig, 'diag', None), 'constraint_name', None)
+        if constraint is not None:
+            return constraint in names
+        message = str(error.orig)
+        if message == f'UNIQUE constraint failed: {table.name}.slug':
+            return True
+        return any(re.search(rf"for key '(?:{table.name}\.)?{re.escape(name)}'", message) for name in names)
+
+    def allocate_slug(self, base):
+        """Assign a unique slug derived from base and flush the record to claim it."""
+        session = db.session
+        bloom = self.taken_slugs()
+        base = base[:self.__table__.c.slug.type.length - 9]
+
+        # the record and the pending records it cascades to, e.g. a registry's address, are
+        # flushed inside the savepoint and everything else before it, so a rejected slug
+        # rolls back only the records that need it
+        state = inspect(self)
+        held = [self] + [x for x, mapper, x_state, x_dict in state.mapper.cascade_iterator('save-update', state)]
+        for instance in held:
+            if instance in session.new:
+                session.expunge(instance)
+        session.flush()
+
+        for attempt in range(self.slug_attempts):
+            if attempt == 0 and (bloom is None or base not in bloom):
+                candidate = base
+            else:
+                candidate = f"{base}-{uuid.uuid4().hex[:8]}"
+            try:
+                with session.begin_nested():
+                    self.slug = candidate
+                    session.add(self)
+            except IntegrityError as ex:
+                if not self.is_slug_collision(ex):
+                    raise
+                if bloom is not None:
+                    bloom.add(candidate)
+                if attempt == self.slug_attempts - 1:
+                    raise
+                continue
+            if bloom is not None:
+                bloom.add(candidate)
+            return candidate
+
+
+# Invalidate cached lookups whenever a cached record is changed or removed,
+# whether through CRUDMixin, Flask-Admin or a bulk query update
+@event.listens_for(db.session, "after_flush")
+def invalidate_flushed_records(session, flush_context):
+    keys = set()
+    for instance in session.dirty | session.deleted:
+        if model_cache.is_cached(instance.__class__):
+            keys |= model_cache.keys_for(instance)
+    if keys:
+        model_cache.invalidate(keys)
+        # invalidate again on commit, in case another request cached the old row in between
+        session.info.setdefault('invalidated_cache_keys', set()).update(keys)
+
+
+@event.listens_for(db.session, "after_commit")
+def invalidate_committed_records(session):
+    model_cache.invalidate(session.info.pop('invalidated_cache_keys', ()))
+
+
+@event.listens_for(db.session, "after_bulk_update")
+def invalidate_bulk_updated_records(update_context):
+    model_cache.invalidate_model(update_context.mapper.class_)
+
+
+@event.listens_for(db.session, "after_bulk_delete")
+def invalidate_bulk_deleted_records(delete_context):
+    model_cache.invalidate_model(delete_context.mapper.class_)
+
+
+@event.listens_for(db.session, "after_flush")
+@event.listens_for(db.session, "after_bulk_update")
+@event.listens_for(db.session, "after_bulk_delete")
+def record_write(*args):
+    if has_request_context():
+        g.db_wrote = True
+
 
 def reference_col(
     tablename, nullable=False, pk_name="id", foreign_key_kwargs=None, column_kwargs=None
@@ -109,6 +505,7 @@ def reference_col(
 
 # Mixins for Generic relationships
 # Based off this https://github.com/zzzeek/sqlalchemy/blob/master/examples/generic_associations/generic_fk.py
+# Parents are told apart by their type_code, a SmallInteger listed in the registry_types table
 
 
 class HasAddress(object):
@@ -120,12 +517,12 @@ class HasAddress(object):
 @event.listens_for(HasAddress, "mapper_configured", propagate=True)
 def setup_address_listener(mapper, class_):
     name = class_.__name__
-    discriminator = name.lower()
+    discriminator = class_.type_code
     class_.address = relationship(
         'RegistryDeliveryAddress',
-        primaryjoin=f"and_({name}.id == foreign(RegistryDeliveryAddress.registry_id), RegistryDeliveryAddress.registry_type == '{discriminator}')",
+        primaryjoin=f"and_({name}.id == foreign(RegistryDeliveryAddress.registry_id), RegistryDeliveryAddress.registry_type == {discriminator})",
         backref=backref(
-            "parent_%s" % discriminator,
+            "parent_%s" % name.lower(),
             uselist=False
         ),
         uselist=False
@@ -145,12 +542,12 @@ class HasProducts(object):
 @event.listens_for(HasProducts, "mapper_configured", propagate=True)
 def setup_product_listener(mapper, class_):
     name = class_.__name__
-    discriminator = name.lower()
+    discriminator = class_.type_code
     class_.products = relationship(
         'RegistryProducts',
-        primaryjoin=f"and_({name}.id == foreign(RegistryProducts.registry_id), RegistryProducts.registry_type == '{discriminator}')",
+        primaryjoin=f"and_({name}.id == foreign(RegistryProducts.registry_id), RegistryProducts.registry_type == {discriminator})",
         backref=backref(
-            "parent_%s" % discriminator,
+            "parent_%s" % name.lower(),
         ),
     )
 
@@ -168,12 +565,12 @@ class HasOrders(object):
 @event.listens_for(HasOrders, "mapper_configured", propagate=True)
 def setup_order_listener(mapper, class_):
     name = class_.__name__
-    discriminator = name.lower()
+    discriminator = class_.type_code
     class_.orders = relationship(
         'Order',
-        primaryjoin=f"and_({name}.id == foreign(Order.registry_id), Order.registry_type == '{discriminator}')",
+        primaryjoin=f"and_({name}.id == foreign(Order.registry_id), Order.registry_type == {discriminator})",
         backref=backref(
-            "parent_%s" % discriminator,
+            "parent_%s" % name.lower(),
         ),
     )
 
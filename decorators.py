@@ -1,5 +1,5 @@
 from functools import wraps
-from flask import current_app, request, redirect, url_for
+from flask import current_app, request, redirect, url_for, g
 from flask_login import current_user
 from flask_login.config import EXEMPT_METHODS
 
@@ -15,3 +15,12 @@ def custom_login_required(func):
             return redirect(url_for('.login'))
         return func(*args, **kwargs)
     return decorated_view
+
+
+def replica_reads(func):
+    """Let GET requests to this view read from the read replica, when one is configured"""
+    @wraps(func)
+    def decorated_view(*args, **kwargs):
+        g.replica_reads = True
+        return func(*args, **kwargs)
+    return decorated_view
@@ -1,14 +1,18 @@
-from flask import redirect, render_template, url_for, Blueprint, flash, request, abort, session, jsonify
+from flask import redirect, render_template, url_for, Blueprint, flash, request, abort, session, jsonify, current_app
 from forms import RegistrationForm, LoginForm, VerificationForm, AddCartDiscount, OrderForm, NewsletterForm,\
     DonationForm, WeddingRegistryForm, BabyShowerForm, BridalShowerForm, BirthdayForm, RegistryProductForm
-from decorators import custom_login_required
+from decorators import custom_login_required, replica_reads
+from database import Page
 from models import db, User, Product, Article, Tag, RegistryProducts, Category, RegistryDeliveryAddress, \
-    Discount, Order, OrderItem, Newsletter, Transaction, Donation, WeddingRegistry, BabyShowerRegistry, BridalShowerRegistry, BirthdayRegistry
+    Discount, Newsletter, Transaction, Donation, WeddingRegistry, BabyShowerRegistry, BridalShowerRegistry, BirthdayRegistry, \
+    RegistrySearch, RegistryBase, PaymentEvent
 from flask_security.utils import hash_password, logout_user, login_user, verify_password
 from flask_security import current_user
 from utils import generate_full_file_path, generate_folder_name
 from werkzeug.utils import secure_filename
-from payment import PaystackPay
+from payment import PaystackPay, PaystackError, processed_references
+from checkout import create_order_transaction, revalidate_cart
+from cart import cart_store
 import os
 import datetime
 
@@ -22,6 +26,12 @@ REGISTRY_TYPES = {
 }
 
 
+@frontend.app_context_processor
+def inject_cart():
+    # called from templates only when the cart is shown, so other pages skip loading it
+    return {'cart_items': cart_store.items}
+
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_IMAGE_EXTENSIONS
 
@@ -178,7 +188,7 @@ def create_registry(slug=None):
             # create hashtag
             wedding.generate_hashtag()
             wedding.generate_slug()
-            wedding.address.registry_type = wedding.__class__.__name__.lower()
+            wedding.address.registry_type = wedding.type_code
             wedding.save()
 
             # todo send email
@@ -211,7 +221,7 @@ def create_registry(slug=None):
             # create hashtag
             baby.generate_hashtag()
             baby.generate_slug()
-            baby.address.registry_type = baby.__class__.__name__.lower()
+            baby.address.registry_type = baby.type_code
             baby.save()
 
             # todo send email
@@ -244,7 +254,7 @@ def create_registry(slug=None):
             # create hashtag
             bride.generate_hashtag()
             bride.generate_slug()
-            bride.address.registry_type = bride.__class__.__name__.lower()
+            bride.address.registry_type = bride.type_code
             bride.save()
 
             # todo send email
@@ -277,7 +287,7 @@ def create_registry(slug=None):
             # create hashtag
             birthday.generate_hashtag()
             birthday.generate_slug()
-            birthday.address.registry_type = birthday.__class__.__name__.lower()
+            birthday.address.registry_type = birthday.type_code
             birthday.save()
 
             # todo send email
@@ -298,7 +308,7 @@ def manage_products(cat, slug):
         return redirect(url_for('.index'))
 
     # load registry
-    registry = category.get_by_slug(slug)
+    registry = category.with_page_data().filter_by(slug=slug).first()
 
     if not registry:
         abort(404)
@@ -314,8 +324,9 @@ def manage_products(cat, slug):
     categories = Category.query.all()
 
     if form.validate_on_submit():
-        # populate products
-        RegistryProducts.query.filter_by(registry_id=registry.id, registry_type=str(category.__name__).lower()).delete()
+        # populate products, deleting through the session so the registry counts follow
+        for item in registry.products:
+            db.session.delete(item)
         db.session.commit()
         product_list = []
         for item in form.products.data:
@@ -384,7 +395,9 @@ def remove_product(cat, slug, product_id):
         flash("This product is not in your registry wishlist", "error")
         return redirect(url_for('.manage_products', cat=cat, slug=slug))
 
-    RegistryProducts.query.filter_by(product_id=product.id, registry_id=registry.id, registry_type=category.__name__.lower()).delete()
+    for item in registry.products:
+        if item.product_id == product.id:
+            db.session.delete(item)
     db.session.commit()
 
     flash("This product has been removed from your registry wishlist", "success")
@@ -450,6 +463,7 @@ def logout():
 
 
 @frontend.route('/blog', methods=['GET'])
+@replica_reads
 def blog():
     articles = Article.query.filter_by(is_published=True).all()
     tags = Tag.get_popular_tags(5)
@@ -457,6 +471,7 @@ def blog():
 
 
 @frontend.route('/blog/<slug>', methods=['GET'])
+@replica_reads
 def blog_article(slug):
     article = Article.get_by_slug(slug)
     if not article:
@@ -467,6 +482,7 @@ def blog_article(slug):
 
 
 @frontend.route('/registries/<cat>', methods=['GET'])
+@replica_reads
 def registries(cat=None):
     if not cat:
         flash('The registry category was not specified', 'error')
@@ -478,16 +494,28 @@ def registries(cat=None):
         flash('The registry category does not exist', 'error')
         return redirect(url_for('.index'))
 
+    per_page = current_app.config['REGISTRIES_PER_PAGE']
     search = request.args.get('q', None)
     if search:
-        search_term = "%{}%".format(request.args.get('q', None))
-        reg_list = category.search(term=search_term).all()
+        page = Page(items=category.search(term=search).limit(per_page).all(), next_cursor=None, prev_cursor=None)
     else:
-        reg_list = category.get_active_records()
-    return render_template('frontend/registries.html', registries=reg_list, reg_type=cat)
+        page = category.get_active_page(after=request.args.get('after'), before=request.args.get('before'),
+                                        per_page=per_page)
+    return render_template('frontend/registries.html', registries=page.items, page=page, reg_type=cat)
+
+
+@frontend.route('/search', methods=['GET'])
+@replica_reads
+def search_registries():
+    search = request.args.get('q', None)
+    reg_list = RegistrySearch.search(search) if search else []
+    categories = {value.__name__: key for key, value in REGISTRY_TYPES.items()}
+    results = [(categories[x.__class__.__name__], x) for x in reg_list]
+    return render_template('frontend/search.html', results=results)
 
 
 @frontend.route('/registries/<cat>/<slug>', methods=['GET', 'POST'])
+@replica_reads
 def view_registry(cat, slug):
     category = REGISTRY_TYPES.get(cat, None)
 
@@ -495,7 +523,7 @@ def view_registry(cat, slug):
         flash('The registry category does not exist', 'error')
         return redirect(url_for('.index'))
 
-    registry = category.get_by_slug(slug)
+    registry = category.with_page_data().filter_by(slug=slug).first()
 
     if not registry:
         flash('The registry does not exist', 'error')
@@ -509,22 +537,22 @@ def view_registry(cat, slug):
             tran.total_amount = form.amount.data
             tran.payment_status = 'unpaid'
             tran.type = 'donation'
-            tran.save()
-
             tran.generate_txn_number()
-            tran.save()
 
             donation = Donation()
             donation.registry_id = registry.id
-            donation.transaction_id = tran.id
+            donation.transaction = tran
             donation.amount = form.amount.data
             donation.save()
 
             # initialize payments
             paystack = PaystackPay()
-            response = paystack.fetch_authorization_url(email=tran.email, amount=tran.total_amount)
+            try:
+                response = paystack.fetch_authorization_url(email=tran.email, amount=tran.total_amount)
+            except PaystackError:
+                response = None
 
-            if response.status_code == 200:
+            if response is not None and response.status_code == 200:
                 json_response = response.json()
 
                 tran.update(payment_txn_number=json_response['data']['reference'])
@@ -537,6 +565,7 @@ def view_registry(cat, slug):
 
 
 @frontend.route('/products/<slug>', methods=['GET'])
+@replica_reads
 def product_details(slug):
     product = Product.get_by_slug(slug)
     if not product:
@@ -578,59 +607,45 @@ def handle_500(e):
 
 @frontend.route('/cart', methods=['GET'])
 def cart():
-    if 'cart_item' not in session:
+    products = cart_store.items()
+    if not products:
         flash("There are no items in your cart", "error")
         return redirect(url_for('.index'))
 
     discount_form = AddCartDiscount()
-    products = session['cart_item']
     return render_template('frontend/cart.html', products=products, discount_form=discount_form)
 
 
 @frontend.route('/checkout', methods=['GET', 'POST'])
 def checkout():
+    shopping_cart = cart_store.cart()
+    if not shopping_cart or not shopping_cart.total_quantity:
+        flash("There are no items in your cart", "error")
+        return redirect(url_for('.index'))
+
     form = OrderForm(request.form)
     if request.method == 'POST' and form.validate():
-        tran = Transaction()
-        form.populate_obj(tran)
-        tran.type = 'order'
-        tran.total_amount = session['all_total_price']
-        tran.payment_status = 'unpaid'
-        tran.save()
-
-        tran.generate_txn_number()
-        if 'discount_id' in session:
-            tran.discount_id = session['discount_id']
-            tran.discounted_amount = session['discounted_price']
-        tran.save()
-
-        # save order items
-        for key, product in session['cart_item'].items():
-            # check if there is an existing order
-            order = Order.query.filter_by(transaction_id=tran.id, registry_id=product['registry_id'], registry_type=product['registry_type']).first()
-
-            if not order:
-                order = Order()
-                order.registry_id = product['registry_id']
-                order.registry_type = product['registry_type']
-                order.transaction_id = tran.id
-                order.status = 'pending'
-                order.save()
-
-                order.generate_order_number()
-                order.save()
-
-            item = OrderItem(order_id=order.id, reg_product_id=key, quantity=product['quantity'],
-                             unit_price=product['unit_price'],
-                             total_price=product['total_price'])
-            item.save()
+        items, changes = revalidate_cart(shopping_cart)
+        if changes or not items:
+            db.session.commit()
+            cart_store.changed(shopping_cart)
+            for message in changes:
+                flash(message, 'error')
+            return redirect(url_for('.checkout'))
+
+        tran = create_order_transaction(form, items, shopping_cart.total_price,
+                                        discount_id=shopping_cart.discount_id,
+                                        discounted_amount=shopping_cart.discounted_price)
 
         # initialize payments
         paystack = PaystackPay()
         amount = tran.discounted_amount if tran.discounted_amount else tran.total_amount
-        response = paystack.fetch_authorization_url(email=tran.email, amount=amount)
+        try:
+            response = paystack.fetch_authorization_url(email=tran.email, amount=amount)
+        except PaystackError:
+            response = None
 
-        if response.status_code == 200:
+        if response is not None and response.status_code == 200:
             json_response = response.json()
 
             tran.update(payment_txn_number=json_response['data']['reference'])
@@ -639,7 +654,7 @@ def checkout():
             flash('Something went wrong. Please try again', 'error')
             return redirect(url_for('.checkout'))
 
-    products = session['cart_item']
+    products = cart_store.items()
     return render_template('frontend/checkout.html', form=form, products=products)
 
 
@@ -651,8 +666,12 @@ def verify_payment():
         flash('Payment failed. Please try again', 'error')
         return redirect(url_for('.checkout'))
 
+    if processed_references.seen(reference):
+        flash('Payment successful', 'success')
+        return redirect(url_for('.checkout'))
+
     # get order
-    tran = Transaction.query.filter_by(payment_txn_number=reference).first()
+    tran = Transaction.get_by_reference(reference)
 
     if not tran:
         flash('Something went wrong. Please contact an administrator', 'error')
@@ -662,44 +681,40 @@ def verify_payment():
         flash('Payment successful', 'success')
         return redirect(url_for('.checkout'))
 
-    paystack = PaystackPay()
-    response = paystack.verify_reference_transaction(reference)
-
-    if response.status_code == 200:
-        tran.update(payment_status='paid', date_paid=datetime.datetime.now())
-        # todo send emails to admin, customer, and purchaser
-        flash('Your purchase has been completed', 'success')
-    else:
-        flash('The transaction could not be completed. Please try again', 'error')
+    # verified with Paystack by `manage.py verify_payments`
+    PaymentEvent.enqueue(reference, 'callback')
+    flash('Thank you. Your payment is being confirmed and your purchase will be completed shortly', 'success')
     return redirect(url_for('.index'))
 
 
-@frontend.route('/cart/verify-payment-webhook', methods=['GET', 'POST'])
+@frontend.route('/cart/verify-payment-webhook', methods=['POST'])
 def verify_payment_webhook():
-    reference = request.args.get('reference')
+    # only Paystack can sign an event, so unsigned requests are refused before anything is stored
+    if not PaystackPay().is_valid_signature(request.get_data(), request.headers.get('x-paystack-signature')):
+        return jsonify({'error': 'Invalid signature'}), 401
+
+    event = request.get_json(silent=True) or {}
+    if event.get('event') != 'charge.success':
+        return jsonify({'message': "Ignored"}), 200
 
+    data = event.get('data') or {}
+    reference = data.get('reference')
     if not reference:
         return jsonify({'error': 'No reference provided'}), 400
 
-    # get order
-    tran = Transaction.query.filter_by(payment_txn_number=reference).first()
-
-    if not tran:
-        return jsonify({'error': 'Reference code not found'}), 404
-
-    if tran.payment_status == 'paid':
+    if processed_references.seen(reference):
         return jsonify({'message': "Success"}), 200
 
-    paystack = PaystackPay()
-    response = paystack.verify_reference_transaction(reference)
-
-    if response.status_code == 200:
-        tran.update(payment_status='paid', date_paid=datetime.datetime.now())
-
-        # todo send emails to admin, customer, and purchaser
-        return jsonify({'message': "Your purchase has been completed"}), 200
+    # a signed event for the amount and currency we asked for needs no call back to Paystack
+    tran = Transaction.get_by_reference(reference)
+    if tran and data.get('amount') == int(tran.get_amount_paid * 100) and \
+            data.get('currency') == current_app.config.get('PAYSTACK_CURRENCY', 'NGN'):
+        tran.mark_paid()
+        processed_references.remember(reference)
     else:
-        return jsonify({'error': "The transaction could not be verified"}), 400
+        current_app.logger.warning('Webhook for %s does not match its transaction, verifying with Paystack', reference)
+        PaymentEvent.enqueue(reference, 'webhook')
+    return jsonify({'message': "Success"}), 200
 
 
 @frontend.route('/add-cart-discount', methods=['POST'])
@@ -711,13 +726,8 @@ def add_cart_discount():
 
         if discount:
             if discount.is_active:
-                # calculate discount
-                discount_amount = discount.get_discount_amount(session['all_total_price'])
-                session.modified = True
-                # update cart
-                session['discount_amount'] = discount_amount
-                session['discounted_price'] = session['all_total_price'] - discount_amount
-                session['discount_id'] = discount.id
+                # the cart recalculates the discount whenever its lines change
+                cart_store.apply_discount(discount)
                 flash("Your discount has been successfully applied", 'success')
             else:
                 flash("The discount code you entered has expired", 'error')
@@ -729,7 +739,10 @@ def add_cart_discount():
 @frontend.route('/cart/add-product/<cat>/<product_id>', methods=['GET'])
 def add_product_to_cart(cat, product_id):
     _quantity = 1
-    product = RegistryProducts.query.get(product_id)
+    product = RegistryProducts.with_product_data().get(product_id)
+
+    if not product:
+        abort(404)
 
     category = REGISTRY_TYPES.get(cat, None)
 
@@ -743,89 +756,78 @@ def add_product_to_cart(cat, product_id):
         flash('The registry does not exist', 'error')
         return redirect(url_for('.index'))
 
-    if not product:
-        abort(404)
-
     if not product.product.is_available:
         flash("This product is currently out of stock", "error")
         return redirect(url_for('.index'))
 
-    all_total_price = 0
-    all_total_quantity = 0
-    session.modified = True
-
-    registry_dict = {'id': registry.id, 'name': registry.name, 'url': registry.url, 'slug': registry.slug}
-    if 'cart_item' in session:
-        if product_id in session['cart_item']:
-            for key, value in session['cart_item'].items():
-                if product_id == key:
-                    old_quantity = session['cart_item'][key]['quantity']
-                    total_quantity = old_quantity + _quantity
-                    session['cart_item'][key]['quantity'] = total_quantity
-                    session['cart_item'][key]['unit_price'] = product.product.price
-                    session['cart_item'][key]['total_price'] = total_quantity * product.product.price
-                    session['cart_item'][key]['product'] = product.product.to_json
-                    session['cart_item'][key]['registry_id'] = product.registry_id
-                    session['cart_item'][key]['registry_type'] = product.registry_type
-                    session['cart_item'][key]['registry'] = registry_dict
-        else:
-            session['cart_item'][product_id] = {'quantity': _quantity, 'unit_price': product.product.price,
-                                                'product': product.product.to_json, 'registry_id': product.registry_id,
-                                                'registry_type': product.registry_type, 'registry': registry_dict,
-                                                'total_price': _quantity * product.product.price}
-    else:
-        session['cart_item'] = {product_id: {'quantity': _quantity, 'unit_price': product.product.price,
-                                             'product': product.product.to_json, 'registry_id': product.registry_id,
-                                             'registry_type': product.registry_type, 'registry': registry_dict,
-                                             'total_price': _quantity * product.product.price}}
-
-    for key, value in session['cart_item'].items():
-        individual_quantity = int(session['cart_item'][key]['quantity'])
-        individual_price = float(session['cart_item'][key]['total_price'])
-        all_total_quantity = all_total_quantity + individual_quantity
-        all_total_price = all_total_price + individual_price
-
-    session['all_total_quantity'] = all_total_quantity
-    session['all_total_price'] = all_total_price
+    cart_store.add(product, _quantity)
 
     flash('Your cart has been updated', 'success')
     return redirect(url_for('.view_registry', cat=cat, slug=registry.slug))
 
 
+@frontend.route('/api/cart', methods=['GET'])
+def api_cart():
+    return jsonify(cart_store.summary()), 200
+
+
+@frontend.route('/api/cart/items', methods=['POST'])
+def api_add_cart_item():
+    # a JSON body can't be posted cross-site without a CORS preflight
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON body'}), 400
+
+    try:
+        reg_product_id = int(data.get('reg_product_id'))
+        quantity = int(data.get('quantity', 1))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid product or quantity'}), 400
+
+    if not 1 <= quantity <= current_app.config['CART_MAX_QUANTITY']:
+        return jsonify({'error': 'Invalid product or quantity'}), 400
+
+    product = RegistryProducts.with_product_data().get(reg_product_id)
+
+    if not product:
+        return jsonify({'error': 'The product does not exist'}), 404
+
+    registry = RegistryBase.for_type_code(product.registry_type).get_by_id(product.registry_id)
+
+    if not registry:
+        return jsonify({'error': 'The registry does not exist'}), 404
+
+    if not product.product.is_available:
+        return jsonify({'error': 'This product is currently out of stock'}), 400
+
+    cart_store.add(product, quantity)
+    return jsonify(cart_store.summary()), 201
+
+
+@frontend.route('/api/cart/items/<int:reg_product_id>', methods=['DELETE'])
+def api_remove_cart_item(reg_product_id):
+    cart_store.remove(reg_product_id)
+
+    if not session.get('all_total_quantity'):
+        cart_store.clear()
+
+    return jsonify(cart_store.summary()), 200
+
+
 @frontend.route('/cart/empty', methods=['GET'])
 def empty_cart():
-    try:
-        session.clear()
-        return redirect(url_for('.index'))
-    except Exception as e:
-        print(e)
+    cart_store.clear()
+    session.clear()
+    return redirect(url_for('.index'))
 
 
-@frontend.route('/cart/delete/<string:product_id>', methods=['GET'])
+@frontend.route('/cart/delete/<int:product_id>', methods=['GET'])
 def delete_product(product_id):
-    try:
-        all_total_price = 0
-        all_total_quantity = 0
-        session.modified = True
-
-        for item in session['cart_item'].items():
-            if item[0] == product_id:
-                session['cart_item'].pop(item[0], None)
-                if 'cart_item' in session:
-                    for key, value in session['cart_item'].items():
-                        individual_quantity = int(session['cart_item'][key]['quantity'])
-                        individual_price = float(session['cart_item'][key]['total_price'])
-                        all_total_quantity = all_total_quantity + individual_quantity
-                        all_total_price = all_total_price + individual_price
-                break
+    cart_store.remove(product_id)
 
-        if all_total_quantity == 0:
-            session.clear()
-        else:
-            session['all_total_quantity'] = all_total_quantity
-            session['all_total_price'] = all_total_price
+    if not session.get('all_total_quantity'):
+        cart_store.clear()
+        session.clear()
 
-        flash("Your cart has been updated", 'success')
-        return redirect(url_for('.cart'))
-    except Exception as e:
-        print(e)
+    flash("Your cart has been updated", 'success')
+    return redirect(url_for('.cart'))
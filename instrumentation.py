@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Per-request SQL instrumentation: statement counts, database time and repeated statements."""
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# collapse IN lists so "IN (?, ?)" and "IN (?, ?, ?)" share a fingerprint
+IN_LIST = re.compile(r'\((?:\s*(?:\?|%s|:\w+)\s*,)+\s*(?:\?|%s|:\w+)\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    """Normalize a statement so repeats of the same query with different parameters match."""
+    return IN_LIST.sub('(?)', WHITESPACE.sub(' ', statement)).strip()
+
+
+class RequestQueries(object):
+    """Statements issued while handling one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.fingerprints[fingerprint(statement)] += 1
+
+    @property
+    def most_repeated(self):
+        if not self.fingerprints:
+            return None, 0
+        return self.fingerprints.most_common(1)[0]
+
+
+class EndpointStats(object):
+    """Running totals of the requests handled by one endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.duration = 0.0
+        self.max_queries = 0
+        self.repeated_statement = None
+        self.repeated_count = 0
+
+    def add(self, queries):
+        self.requests += 1
+        self.queries += queries.count
+        self.duration += queries.duration
+        self.max_queries = max(self.max_queries, queries.count)
+        statement, count = queries.most_repeated
+        if count > self.repeated_count:
+            self.repeated_statement, self.repeated_count = statement, count
+
+    @property
+    def avg_queries(self):
+        return self.queries / self.requests if self.requests else 0
+
+    @property
+    def avg_duration_ms(self):
+        return self.duration * 1000 / self.requests if self.requests else 0
+
+
+class Histogram(object):
+    """Counts of observed durations (in seconds) per latency bucket."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(self.BUCKETS) if value <= bound), len(self.BUCKETS))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    @property
+    def avg_ms(self):
+        return self.total * 1000 / self.count if self.count else 0
+
+    @property
+    def buckets(self):
+        """(label, count) for each bucket, e.g. ('<= 5ms', 12)"""
+        labels = [f'<= {bound * 1000:g}ms' for bound in self.BUCKETS] + [f'> {self.BUCKETS[-1] * 1000:g}ms']
+        return list(zip(labels, self.counts))
+
+
+class SQLInstrumentation(object):
+    """Records the SQL each request issues, adds a Server-Timing header and flags N+1 patterns."""
+
+    def __init__(self, app=None):
+        self.stats = {}
+        self._lock = threading.Lock()
+        self.threshold = 10
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('SQL_INSTRUMENTATION', True):
+            return
+        self.threshold = app.config.get('SQL_REPEAT_WARNING_THRESHOLD', 10)
+
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(Engine, 'handle_error', handle_error)
+
+        app.before_request(start_request)
+        app.after_request(self.finish_request)
+
+    def finish_request(self, response):
+        queries = g.pop('sql_queries', None)
+        if queries is None:
+            return response
+
+        response.headers.add('Server-Timing', f'db;desc="{queries.count} queries";dur={queries.duration * 1000:.1f}')
+
+        statement, count = queries.most_repeated
+        if count > self.threshold:
+            current_app.logger.warning('Possible N+1 on %s: statement ran %d times: %s',
+                                       request.endpoint, count, statement)
+
+        with self._lock:
+            self.stats.setdefault(request.endpoint or request.path, EndpointStats()).add(queries)
+        return response
+
+    def snapshot(self):
+        """Endpoint stats ordered by average statements per request."""
+        with self._lock:
+            return sorted(self.stats.items(), key=lambda x: x[1].avg_queries, reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+
+
+def start_request():
+    g.sql_queries = RequestQueries()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_start_time'].pop()
+    if has_request_context():
+        queries = g.get('sql_queries')
+        if queries is not None:
+            queries.record(statement, time.perf_counter() - started)
+
+
+def handle_error(context):
+    # after_cursor_execute does not run for failed statements
+    if context.connection is not None and context.connection.info.get('query_start_time'):
+        context.connection.info['query_start_time'].pop()
+
+
+@contextmanager
+def captured_statements(engine):
+    """Collect the (statement, parameters) of every SELECT sent through engine inside the block"""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+
+sql_instrumentation = SQLInstrumentation()
@@ -1,9 +1,25 @@
+import sys
+import time
+import datetime as dt
+from functools import partial
 from flask_script import Manager
+from werkzeug.serving import run_simple
+from sqlalchemy import and_, func, select
 from app import app, db
-from models import Role
+from cache import ModelCache
+from database import encode_cursor
+from instrumentation import captured_statements
+from payment_worker import PaymentVerifier, reconcile as reconcile_transactions
+from paystack_simulator import create_simulator
+from models import Role, RegistrySearch, WeddingRegistry, BabyShowerRegistry, BridalShowerRegistry, \
+    BirthdayRegistry, RegistryProducts, Order, OrderItem, Transaction, Donation, Product, \
+    Cart, CartItem, ProcessedPayment, User
 
 manager = Manager(app)
 
+# looked up by check_query_plans; no record has it, so every lookup reaches the database
+MISSING = 'check-query-plans'
+
 
 @manager.command
 def seed():
@@ -18,5 +34,176 @@ def seed():
         db.session.commit()
         print("Completed successfully...")
 
+
+@manager.command
+def index_registries():
+    """Rebuild the registry search index from the registry tables"""
+    connection = db.session.connection()
+    for model in (WeddingRegistry, BabyShowerRegistry, BridalShowerRegistry, BirthdayRegistry):
+        count = 0
+        for registry in model.query.yield_per(500):
+            RegistrySearch.index(connection, registry)
+            count += 1
+        print(f"Indexed {count} {model.__tablename__}")
+    db.session.commit()
+    print("Completed successfully...")
+
+
+@manager.command
+def repair_registry_aggregates():
+    """Recompute the product, purchase, donation and order totals of every registry"""
+    products = RegistryProducts.__table__
+    items, orders, transactions = OrderItem.__table__, Order.__table__, Transaction.__table__
+    donations = Donation.__table__
+    for model in (WeddingRegistry, BabyShowerRegistry, BridalShowerRegistry, BirthdayRegistry):
+        table = model.__table__
+        registry_products = and_(products.c.registry_type == model.type_code, products.c.registry_id == table.c.id)
+        values = {
+            'product_count': select([func.count(products.c.id)]).where(registry_products).as_scalar(),
+            'purchased_count': select([func.count(products.c.id)]).
+            where(and_(registry_products, products.c.has_been_purchased.is_(True))).as_scalar(),
+            'total_ordered': select([func.coalesce(func.sum(items.c.total_price), 0)]).
+            select_from(items.join(orders).join(transactions)).
+            where(and_(orders.c.registry_type == model.type_code, orders.c.registry_id == table.c.id,
+                       transactions.c.payment_status == 'paid')).as_scalar(),
+        }
+        if model is WeddingRegistry:
+            values['total_donated'] = select([func.coalesce(func.sum(donations.c.amount), 0)]).\
+                select_from(donations.join(transactions)).\
+                where(and_(donations.c.registry_id == table.c.id, transactions.c.payment_status == 'paid')).as_scalar()
+        result = db.session.execute(table.update().values(values))
+        print(f"Repaired {result.rowcount} {model.__tablename__}")
+    db.session.commit()
+    print("Completed successfully...")
+
+
+@manager.command
+def purge_carts():
+    """Delete carts nobody has touched for CART_RETENTION_DAYS"""
+    cutoff = dt.datetime.utcnow() - dt.timedelta(days=app.config['CART_RETENTION_DAYS'])
+    stale = db.session.query(Cart.id).filter(Cart.date_updated < cutoff)
+    CartItem.query.filter(CartItem.cart_id.in_(stale.subquery())).delete(synchronize_session=False)
+    count = Cart.query.filter(Cart.date_updated < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    print(f"Deleted {count} carts")
+
+
+@manager.command
+def check_carts():
+    """Verify the running totals of every cart against its lines"""
+    failures = 0
+    for cart in Cart.query.yield_per(500):
+        for problem in cart.check_totals():
+            failures += 1
+            print(f"cart {cart.id}: {problem}")
+    if failures:
+        sys.exit(1)
+    print("Completed successfully...")
+
+
+@manager.option('-w', '--workers', dest='workers', type=int, default=None, help='Worker threads')
+@manager.option('--once', dest='once', action='store_true', help='Exit when no events are due')
+def verify_payments(workers=None, once=False):
+    """Verify queued payment references with Paystack"""
+    processed = PaymentVerifier(app, workers=workers).run(once=once)
+    print(f"Processed {processed} payment events")
+
+
+@manager.option('-m', '--minutes', dest='minutes', type=int, default=None,
+                help='Only transactions created at least this many minutes ago')
+@manager.option('-w', '--workers', dest='workers', type=int, default=None, help='Verification threads')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=None, help='Transactions per batch')
+def reconcile(minutes=None, workers=None, batch_size=None):
+    """Verify old unpaid transactions with Paystack and mark the paid ones"""
+    minutes = app.config['RECONCILE_MIN_AGE_MINUTES'] if minutes is None else minutes
+    started = time.perf_counter()
+    counts = reconcile_transactions(app, minutes, workers=workers, batch_size=batch_size)
+    elapsed = time.perf_counter() - started
+    print(f"Checked {counts['checked']} transactions in {elapsed:.1f}s "
+          f"({counts['checked'] / elapsed if elapsed else 0:.1f}/s): {counts['paid']} paid, "
+          f"{counts['unpaid']} unpaid, {counts['errors']} could not be verified")
+
+
+@manager.option('-h', '--host', dest='host', default='127.0.0.1')
+@manager.option('-p', '--port', dest='port', type=int, default=5055)
+@manager.option('--latency', dest='latency', type=float, default=100, help='Mean latency of API calls in ms')
+@manager.option('--jitter', dest='jitter', type=float, default=50, help='Standard deviation of the latency in ms')
+@manager.option('--error-rate', dest='error_rate', type=float, default=0.0, help='Share of API calls answered with 500')
+@manager.option('--failure-rate', dest='failure_rate', type=float, default=0.0, help='Share of payments that fail')
+@manager.option('--webhook-url', dest='webhook_url', default=None,
+                help='Where to send charge.success webhooks, e.g. http://127.0.0.1:5000/cart/verify-payment-webhook')
+@manager.option('--auto-pay', dest='auto_pay', action='store_true', help='Pay every transaction on initialize')
+def paystack_simulator(host, port, latency, jitter, error_rate, failure_rate, webhook_url=None, auto_pay=False):
+    """Run a local Paystack stand-in; point PAYSTACK_BASE_URL at it"""
+    simulator = create_simulator(app.config['PAYSTACK_SECRET_KEY'] or 'sk_test_simulator',
+                                 latency=latency / 1000, jitter=jitter / 1000, error_rate=error_rate,
+                                 failure_rate=failure_rate, webhook_url=webhook_url, auto_pay=auto_pay,
+                                 currency=app.config.get('PAYSTACK_CURRENCY', 'NGN'))
+    print(f"Set PAYSTACK_BASE_URL=http://{host}:{port} to use the simulator")
+    run_simple(host, port, simulator, threaded=True)
+
+
+def hot_queries():
+    """The lookups the views run on every request, as (name, function) pairs.
+
+    Each function calls the model method, relationship or query the views use, so
+    check_query_plans explains the statements they really send. Lookups are for records
+    that don't exist, so they miss the model cache and always reach the database.
+    """
+    queries = []
+    for model in (WeddingRegistry, BabyShowerRegistry, BridalShowerRegistry, BirthdayRegistry):
+        # attached without a query, so its relationships lazy load as on a registry page
+        registry = ModelCache.restore(db.session, model, {'id': 0, 'date_created': dt.datetime(2000, 1, 1)})
+        queries += [
+            (f'{model.__name__}.get_by_slug', partial(model.get_by_slug, MISSING)),
+            (f'{model.__name__}.with_page_data',
+             lambda model=model: model.with_page_data().filter_by(slug=MISSING).first()),
+            (f'{model.__name__}.get_active_page', model.get_active_page),
+            (f'{model.__name__}.get_active_page after', partial(model.get_active_page, after=encode_cursor(registry))),
+            (f'{model.__name__}.search', lambda model=model: model.search(MISSING).limit(20).all()),
+            (f'{model.__name__}.products', partial(getattr, registry, 'products')),
+            (f'{model.__name__}.address', partial(getattr, registry, 'address')),
+        ]
+    user = ModelCache.restore(db.session, User, {'id': 0})
+    queries += [
+        ('RegistrySearch.search', partial(RegistrySearch.search, MISSING)),
+        ('Transaction.get_by_reference', partial(Transaction.get_by_reference, MISSING)),
+        ('ProcessedPayment.exists', partial(ProcessedPayment.exists, MISSING)),
+        ('User.roles', partial(getattr, user, 'roles')),
+        ('available products', lambda: Product.query.filter_by(is_available=True).all()),
+    ]
+    return queries
+
+
+def full_scans(statement, parameters):
+    """EXPLAIN a statement and return the tables it reads with a full scan"""
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite':
+        plan = connection.execute(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+        # e.g. "SCAN orders" or "SCAN TABLE orders", but not subqueries or "SCAN CONSTANT ROW"
+        scans = [row[-1].replace('SCAN TABLE ', 'SCAN ') for row in plan if row[-1].startswith('SCAN')]
+        return [x for x in scans if 'INDEX' not in x and x.split()[1] in db.metadata.tables]
+    plan = connection.execute(f'EXPLAIN {statement}', parameters)
+    return [row['table'] for row in plan if row['type'] == 'ALL']
+
+
+@manager.command
+def check_query_plans():
+    """Fail if any hot lookup query does a full table scan"""
+    failures = 0
+    for name, lookup in hot_queries():
+        with captured_statements(db.engine) as statements:
+            lookup()
+        scans = [scan for statement, parameters in statements for scan in full_scans(statement, parameters)]
+        if scans:
+            failures += 1
+            print(f"FULL SCAN {name}: {', '.join(scans)}")
+        else:
+            print(f"ok        {name}")
+    if failures:
+        print(f"{failures} queries do full table scans")
+        sys.exit(1)
+    print("Completed successfully...")
+
 if __name__ == "__main__":
     manager.run()
\ No newline at end of file
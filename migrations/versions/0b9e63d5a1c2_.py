@@ -0,0 +1,41 @@
+"""running cart totals
+
+Revision ID: 0b9e63d5a1c2
+Revises: f27b4d9c0e18
+Create Date: 2026-10-18 18:02:44.861350
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b9e63d5a1c2'
+down_revision = 'f27b4d9c0e18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('cart_items', sa.Column('unit_price', sa.Float(), nullable=True))
+    op.execute("UPDATE cart_items SET unit_price = (SELECT p.price FROM registry_products r "
+               "JOIN products p ON p.id = r.product_id WHERE r.id = cart_items.reg_product_id)")
+    op.alter_column('cart_items', 'unit_price', existing_type=sa.Float(), nullable=False)
+
+    op.add_column('carts', sa.Column('total_quantity', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('carts', sa.Column('total_price', sa.Float(), server_default='0', nullable=False))
+    op.add_column('carts', sa.Column('discount_id', sa.Integer(), nullable=True))
+    op.add_column('carts', sa.Column('discount_amount', sa.Float(), server_default='0', nullable=False))
+    op.create_foreign_key('fk_carts_discount_id', 'carts', 'discounts', ['discount_id'], ['id'])
+    op.execute("UPDATE carts SET "
+               "total_quantity = (SELECT COALESCE(SUM(quantity), 0) FROM cart_items WHERE cart_id = carts.id), "
+               "total_price = (SELECT COALESCE(SUM(quantity * unit_price), 0) FROM cart_items WHERE cart_id = carts.id)")
+
+
+def downgrade():
+    op.drop_constraint('fk_carts_discount_id', 'carts', type_='foreignkey')
+    op.drop_column('carts', 'discount_amount')
+    op.drop_column('carts', 'discount_id')
+    op.drop_column('carts', 'total_price')
+    op.drop_column('carts', 'total_quantity')
+    op.drop_column('cart_items', 'unit_price')
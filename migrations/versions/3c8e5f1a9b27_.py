@@ -0,0 +1,33 @@
+"""stop cascading registry product deletes to cart lines
+
+Revision ID: 3c8e5f1a9b27
+Revises: 7a3f9c2e6d15
+Create Date: 2026-10-18 22:14:09.731468
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c8e5f1a9b27'
+down_revision = '7a3f9c2e6d15'
+branch_labels = None
+depends_on = None
+
+
+def replace_foreign_key(ondelete=None):
+    # the key was created unnamed, so its name depends on the database
+    for key in sa.inspect(op.get_bind()).get_foreign_keys('cart_items'):
+        if key['referred_table'] == 'registry_products':
+            op.drop_constraint(key['name'], 'cart_items', type_='foreignkey')
+    op.create_foreign_key('fk_cart_items_reg_product_id', 'cart_items', 'registry_products',
+                          ['reg_product_id'], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    replace_foreign_key()
+
+
+def downgrade():
+    replace_foreign_key(ondelete='CASCADE')
@@ -0,0 +1,36 @@
+"""processed payment references
+
+Revision ID: 7a3f9c2e6d15
+Revises: d59a0e7c3b84
+Create Date: 2026-10-18 20:41:37.502196
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a3f9c2e6d15'
+down_revision = 'd59a0e7c3b84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('processed_payments',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('reference', sa.String(length=255), nullable=False),
+    sa.Column('transaction_id', sa.Integer(), nullable=False),
+    sa.Column('date_processed', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['transaction_id'], ['transactions.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('reference')
+    )
+    # payments made before this table existed
+    op.execute("INSERT INTO processed_payments (reference, transaction_id, date_processed) "
+               "SELECT payment_txn_number, MIN(id), MIN(COALESCE(date_paid, date_created)) FROM transactions "
+               "WHERE payment_status = 'paid' AND payment_txn_number IS NOT NULL GROUP BY payment_txn_number")
+
+
+def downgrade():
+    op.drop_table('processed_payments')
@@ -0,0 +1,46 @@
+"""add registry search index
+
+Revision ID: 8c1d4f2b7a90
+Revises: 379a6cdbaaf7
+Create Date: 2026-10-18 09:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1d4f2b7a90'
+down_revision = '379a6cdbaaf7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('registry_search',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('registry_type', sa.Unicode(length=255), nullable=False),
+    sa.Column('registry_id', sa.Integer(), nullable=False),
+    sa.Column('slug', sa.String(length=100), nullable=True),
+    sa.Column('is_active', sa.Boolean(), nullable=True),
+    sa.Column('date_created', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('registry_type', 'registry_id', name='uq_registry_search_registry')
+    )
+    op.create_table('registry_search_tokens',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('search_id', sa.Integer(), nullable=False),
+    sa.Column('token', sa.String(length=100), nullable=False),
+    sa.ForeignKeyConstraint(['search_id'], ['registry_search.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_registry_search_tokens_search_id'), 'registry_search_tokens', ['search_id'], unique=False)
+    op.create_index(op.f('ix_registry_search_tokens_token'), 'registry_search_tokens', ['token'], unique=False)
+    # existing registries are indexed with `python manage.py index_registries`
+
+
+def downgrade():
+    op.drop_index(op.f('ix_registry_search_tokens_token'), table_name='registry_search_tokens')
+    op.drop_index(op.f('ix_registry_search_tokens_search_id'), table_name='registry_search_tokens')
+    op.drop_table('registry_search_tokens')
+    op.drop_table('registry_search')
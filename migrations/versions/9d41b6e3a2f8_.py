@@ -0,0 +1,24 @@
+"""cart versions
+
+Revision ID: 9d41b6e3a2f8
+Revises: 3c8e5f1a9b27
+Create Date: 2026-10-19 09:12:44.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d41b6e3a2f8'
+down_revision = '3c8e5f1a9b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('carts', sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('carts', 'version')
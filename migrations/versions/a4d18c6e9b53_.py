@@ -0,0 +1,54 @@
+"""registry aggregate columns
+
+Revision ID: a4d18c6e9b53
+Revises: e3c7a9d15f02
+Create Date: 2026-10-18 16:10:37.902514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d18c6e9b53'
+down_revision = 'e3c7a9d15f02'
+branch_labels = None
+depends_on = None
+
+# table -> registry type code
+REGISTRY_TABLES = {
+    'wedding_registries': 1,
+    'baby_shower_registries': 2,
+    'bridal_shower_registries': 3,
+    'birthday_registries': 4,
+}
+
+
+def upgrade():
+    for table, type_code in REGISTRY_TABLES.items():
+        op.add_column(table, sa.Column('product_count', sa.Integer(), server_default='0', nullable=False))
+        op.add_column(table, sa.Column('purchased_count', sa.Integer(), server_default='0', nullable=False))
+        op.add_column(table, sa.Column('total_donated', sa.Float(), server_default='0', nullable=False))
+        op.add_column(table, sa.Column('total_ordered', sa.Float(), server_default='0', nullable=False))
+
+        op.execute(
+            f"UPDATE {table} SET "
+            f"product_count = (SELECT COUNT(*) FROM registry_products p "
+            f"WHERE p.registry_type = {type_code} AND p.registry_id = {table}.id), "
+            f"purchased_count = (SELECT COUNT(*) FROM registry_products p "
+            f"WHERE p.registry_type = {type_code} AND p.registry_id = {table}.id AND p.has_been_purchased = 1), "
+            f"total_ordered = (SELECT COALESCE(SUM(i.total_price), 0) FROM order_items i "
+            f"JOIN orders o ON o.id = i.order_id JOIN transactions t ON t.id = o.transaction_id "
+            f"WHERE o.registry_type = {type_code} AND o.registry_id = {table}.id AND t.payment_status = 'paid')")
+    op.execute(
+        "UPDATE wedding_registries SET total_donated = (SELECT COALESCE(SUM(d.amount), 0) FROM donations d "
+        "JOIN transactions t ON t.id = d.transaction_id "
+        "WHERE d.registry_id = wedding_registries.id AND t.payment_status = 'paid')")
+
+
+def downgrade():
+    for table in REGISTRY_TABLES:
+        op.drop_column(table, 'total_ordered')
+        op.drop_column(table, 'total_donated')
+        op.drop_column(table, 'purchased_count')
+        op.drop_column(table, 'product_count')
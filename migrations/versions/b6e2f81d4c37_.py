@@ -0,0 +1,108 @@
+"""store the registry type as a SmallInteger code
+
+Revision ID: b6e2f81d4c37
+Revises: f5a93c2e8d14
+Create Date: 2026-10-18 14:05:48.302115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e2f81d4c37'
+down_revision = 'f5a93c2e8d14'
+branch_labels = None
+depends_on = None
+
+REGISTRY_TYPES = [
+    {'id': 1, 'name': 'weddingregistry'},
+    {'id': 2, 'name': 'babyshowerregistry'},
+    {'id': 3, 'name': 'bridalshowerregistry'},
+    {'id': 4, 'name': 'birthdayregistry'},
+]
+# table -> indexes covering registry_type, as (name, columns, unique)
+TABLES = {
+    'registry_products': [('ix_registry_products_registry', ['registry_type', 'registry_id'], False)],
+    'registry_delivery_addresses': [('ix_registry_delivery_addresses_registry', ['registry_type', 'registry_id'], False)],
+    'orders': [('ix_orders_transaction_registry', ['transaction_id', 'registry_type', 'registry_id'], False)],
+    'registry_search': [('uq_registry_search_registry', ['registry_type', 'registry_id'], True)],
+}
+# indexes that back a foreign key on MySQL once the composite index above is gone; MySQL
+# refuses to drop the only index covering a foreign key (error 1553), so these are created
+# before the composite index is dropped and removed again once it has been recreated
+FOREIGN_KEY_INDEXES = {
+    'orders': [('ix_orders_transaction_id', ['transaction_id'])],
+}
+# rows converted per UPDATE, so no statement locks a whole table
+BATCH_SIZE = 5000
+
+
+def convert(table, source, target, mapping):
+    """Fill column target from source in id ranges of BATCH_SIZE rows"""
+    connection = op.get_bind()
+    max_id = connection.execute(sa.text(f'SELECT MAX(id) FROM {table}')).scalar() or 0
+    case = ' '.join(f'WHEN :from_{i} THEN :to_{i}' for i in range(len(mapping)))
+    params = {}
+    for i, (old, new) in enumerate(mapping):
+        params.update({f'from_{i}': old, f'to_{i}': new})
+    statement = sa.text(f'UPDATE {table} SET {target} = CASE {source} {case} END WHERE id > :start AND id <= :end')
+    for start in range(0, max_id, BATCH_SIZE):
+        connection.execute(statement, start=start, end=start + BATCH_SIZE, **params)
+
+
+def drop_indexes(table):
+    for name, columns in FOREIGN_KEY_INDEXES.get(table, []):
+        op.create_index(name, table, columns, unique=False)
+    for name, columns, unique in TABLES[table]:
+        if unique:
+            op.drop_constraint(name, table, type_='unique')
+        else:
+            op.drop_index(name, table_name=table)
+
+
+def create_indexes(table):
+    for name, columns, unique in TABLES[table]:
+        if unique:
+            op.create_unique_constraint(name, table, columns)
+        else:
+            op.create_index(name, table, columns, unique=False)
+    for name, columns in FOREIGN_KEY_INDEXES.get(table, []):
+        op.drop_index(name, table_name=table)
+
+
+def upgrade():
+    registry_types = op.create_table('registry_types',
+    sa.Column('id', sa.SmallInteger(), autoincrement=False, nullable=False),
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.bulk_insert(registry_types, REGISTRY_TYPES)
+
+    mapping = [(x['name'], x['id']) for x in REGISTRY_TYPES]
+    for table in TABLES:
+        required = table == 'registry_search'
+        op.add_column(table, sa.Column('registry_type_code', sa.SmallInteger(), nullable=True))
+        convert(table, 'registry_type', 'registry_type_code', mapping)
+        drop_indexes(table)
+        op.drop_column(table, 'registry_type')
+        op.alter_column(table, 'registry_type_code', new_column_name='registry_type',
+                        existing_type=sa.SmallInteger(), existing_nullable=True, nullable=not required)
+        op.create_foreign_key(f'fk_{table}_registry_type', table, 'registry_types', ['registry_type'], ['id'])
+        create_indexes(table)
+
+
+def downgrade():
+    mapping = [(x['id'], x['name']) for x in REGISTRY_TYPES]
+    for table in TABLES:
+        required = table == 'registry_search'
+        op.add_column(table, sa.Column('registry_type_name', sa.Unicode(length=255), nullable=True))
+        convert(table, 'registry_type', 'registry_type_name', mapping)
+        drop_indexes(table)
+        op.drop_constraint(f'fk_{table}_registry_type', table, type_='foreignkey')
+        op.drop_column(table, 'registry_type')
+        op.alter_column(table, 'registry_type_name', new_column_name='registry_type',
+                        existing_type=sa.Unicode(length=255), existing_nullable=True, nullable=not required)
+        create_indexes(table)
+    op.drop_table('registry_types')
@@ -0,0 +1,31 @@
+"""number blocks for transaction and order numbers
+
+Revision ID: c81f5e2a7d46
+Revises: a4d18c6e9b53
+Create Date: 2026-10-18 16:48:21.550193
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f5e2a7d46'
+down_revision = 'a4d18c6e9b53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('number_blocks',
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('next_value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # numbers used to be the row id, so continue after the highest one
+    for name in ('transactions', 'orders'):
+        op.execute(f"INSERT INTO number_blocks (name, next_value) SELECT '{name}', COALESCE(MAX(id), 0) + 1 FROM {name}")
+
+
+def downgrade():
+    op.drop_table('number_blocks')
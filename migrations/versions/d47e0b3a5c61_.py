@@ -0,0 +1,32 @@
+"""add products.main_image_path
+
+Revision ID: d47e0b3a5c61
+Revises: 8c1d4f2b7a90
+Create Date: 2026-10-18 11:02:17.550931
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd47e0b3a5c61'
+down_revision = '8c1d4f2b7a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('products', sa.Column('main_image_path', sa.Text(), nullable=True))
+
+    # backfill from the main image of each product, falling back to its first image
+    products = sa.table('products', sa.column('id', sa.Integer), sa.column('main_image_path', sa.Text))
+    images = sa.table('product_images', sa.column('id', sa.Integer), sa.column('name', sa.Text),
+                      sa.column('product_id', sa.Integer), sa.column('is_main_image', sa.Boolean))
+    path = sa.select([images.c.name]).where(images.c.product_id == products.c.id).\
+        order_by(images.c.is_main_image.desc(), images.c.id.asc()).limit(1).as_scalar()
+    op.execute(products.update().values(main_image_path=path))
+
+
+def downgrade():
+    op.drop_column('products', 'main_image_path')
@@ -0,0 +1,40 @@
+"""payment events queue
+
+Revision ID: d59a0e7c3b84
+Revises: 0b9e63d5a1c2
+Create Date: 2026-10-18 19:24:05.317842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd59a0e7c3b84'
+down_revision = '0b9e63d5a1c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('payment_events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('reference', sa.String(length=255), nullable=False),
+    sa.Column('source', sa.String(length=20), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('date_created', sa.DateTime(), nullable=False),
+    sa.Column('date_processed', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_payment_events_reference'), 'payment_events', ['reference'], unique=False)
+    op.create_index('ix_payment_events_status_next_attempt_at', 'payment_events', ['status', 'next_attempt_at'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_payment_events_status_next_attempt_at', table_name='payment_events')
+    op.drop_index(op.f('ix_payment_events_reference'), table_name='payment_events')
+    op.drop_table('payment_events')
@@ -0,0 +1,49 @@
+"""unique slugs for registries and tags
+
+Revision ID: e3c7a9d15f02
+Revises: b6e2f81d4c37
+Create Date: 2026-10-18 15:22:10.418093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3c7a9d15f02'
+down_revision = 'b6e2f81d4c37'
+branch_labels = None
+depends_on = None
+
+REGISTRY_TABLES = ['wedding_registries', 'baby_shower_registries', 'bridal_shower_registries', 'birthday_registries']
+
+
+def deduplicate_slugs(table):
+    """Suffix the id to every duplicate slug but the oldest, so the unique index can be built"""
+    connection = op.get_bind()
+    duplicates = connection.execute(sa.text(
+        f'SELECT id, slug FROM {table} WHERE slug IN '
+        f'(SELECT slug FROM (SELECT slug FROM {table} GROUP BY slug HAVING COUNT(*) > 1) AS duplicated) '
+        f'ORDER BY slug, id')).fetchall()
+    seen = set()
+    for record_id, slug in duplicates:
+        if slug in seen:
+            connection.execute(sa.text(f'UPDATE {table} SET slug = :slug WHERE id = :id'),
+                               slug=f'{slug}-{record_id}', id=record_id)
+        seen.add(slug)
+
+
+def upgrade():
+    for table in REGISTRY_TABLES:
+        deduplicate_slugs(table)
+        op.drop_index(op.f(f'ix_{table}_slug'), table_name=table)
+        op.create_index(op.f(f'ix_{table}_slug'), table, ['slug'], unique=True)
+    deduplicate_slugs('tags')
+    op.create_unique_constraint('uq_tags_slug', 'tags', ['slug'])
+
+
+def downgrade():
+    op.drop_constraint('uq_tags_slug', 'tags', type_='unique')
+    for table in REGISTRY_TABLES:
+        op.drop_index(op.f(f'ix_{table}_slug'), table_name=table)
+        op.create_index(op.f(f'ix_{table}_slug'), table, ['slug'], unique=False)
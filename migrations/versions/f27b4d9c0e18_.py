@@ -0,0 +1,42 @@
+"""server-side carts
+
+Revision ID: f27b4d9c0e18
+Revises: c81f5e2a7d46
+Create Date: 2026-10-18 17:31:02.174460
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f27b4d9c0e18'
+down_revision = 'c81f5e2a7d46'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('carts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('date_created', sa.DateTime(), nullable=False),
+    sa.Column('date_updated', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_carts_date_updated'), 'carts', ['date_updated'], unique=False)
+    op.create_table('cart_items',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('cart_id', sa.Integer(), nullable=False),
+    sa.Column('reg_product_id', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['cart_id'], ['carts.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['reg_product_id'], ['registry_products.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('cart_id', 'reg_product_id', name='uq_cart_items_cart_product')
+    )
+
+
+def downgrade():
+    op.drop_table('cart_items')
+    op.drop_index(op.f('ix_carts_date_updated'), table_name='carts')
+    op.drop_table('carts')
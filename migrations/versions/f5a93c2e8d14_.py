@@ -0,0 +1,42 @@
+"""add indexes for hot lookup paths
+
+Revision ID: f5a93c2e8d14
+Revises: d47e0b3a5c61
+Create Date: 2026-10-18 12:40:05.127733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5a93c2e8d14'
+down_revision = 'd47e0b3a5c61'
+branch_labels = None
+depends_on = None
+
+REGISTRY_TABLES = ['wedding_registries', 'baby_shower_registries', 'bridal_shower_registries', 'birthday_registries']
+
+
+def upgrade():
+    op.create_index('ix_registry_products_registry', 'registry_products', ['registry_type', 'registry_id'], unique=False)
+    op.create_index('ix_orders_transaction_registry', 'orders', ['transaction_id', 'registry_type', 'registry_id'], unique=False)
+    op.create_index(op.f('ix_transactions_payment_txn_number'), 'transactions', ['payment_txn_number'], unique=False)
+    op.create_index('ix_registry_delivery_addresses_registry', 'registry_delivery_addresses', ['registry_type', 'registry_id'], unique=False)
+    op.create_index('ix_roles_users_user_id_role_id', 'roles_users', ['user_id', 'role_id'], unique=False)
+    op.create_index('ix_products_is_available_is_bundle', 'products', ['is_available', 'is_bundle'], unique=False)
+    for table in REGISTRY_TABLES:
+        op.create_index(op.f(f'ix_{table}_slug'), table, ['slug'], unique=False)
+        op.create_index(f'ix_{table}_is_active_date_created', table, ['is_active', 'date_created', 'id'], unique=False)
+
+
+def downgrade():
+    for table in REGISTRY_TABLES:
+        op.drop_index(f'ix_{table}_is_active_date_created', table_name=table)
+        op.drop_index(op.f(f'ix_{table}_slug'), table_name=table)
+    op.drop_index('ix_products_is_available_is_bundle', table_name='products')
+    op.drop_index('ix_roles_users_user_id_role_id', table_name='roles_users')
+    op.drop_index('ix_registry_delivery_addresses_registry', table_name='registry_delivery_addresses')
+    op.drop_index(op.f('ix_transactions_payment_txn_number'), table_name='transactions')
+    op.drop_index('ix_orders_transaction_registry', table_name='orders')
+    op.drop_index('ix_registry_products_registry', table_name='registry_products')
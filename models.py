@@ -4,17 +4,25 @@ from database import (
     db,
     Model,
     CustomModelMixin,
+    UniqueSlugMixin,
     reference_col,
     relationship,
     Column,
+    unit_of_work,
+    number_allocator,
     HasAddress, HasProducts, HasOrders
 )
 import datetime as dt
-from sqlalchemy.orm import backref
+from collections import Counter
+from sqlalchemy import and_, or_, func, desc, false, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import backref, joinedload, selectinload
 import random
 from sqlalchemy_utils.types.choice import ChoiceType
 from sqlalchemy.ext.declarative import declared_attr
-import uuid
+from utils import tokenize
+from cache import model_cache
 
 PAYMENT_STATUS = [
     (u'unpaid', u'Unpaid'),
@@ -30,7 +38,8 @@ STATUS = [
 roles_users = db.Table(
     'roles_users',
     db.Column('user_id', db.Integer(), db.ForeignKey('user.id')),
-    db.Column('role_id', db.Integer(), db.ForeignKey('role.id'))
+    db.Column('role_id', db.Integer(), db.ForeignKey('role.id')),
+    db.Index('ix_roles_users_user_id_role_id', 'user_id', 'role_id')
 )
 
 
@@ -71,6 +80,12 @@ class User(db.Model, UserMixin):
             return f'{self.first_name} {self.last_name}'
         return ''
 
+    @property
+    def registries(self):
+        """Registries of every type created by the user"""
+        return [registry for model in RegistryBase.__subclasses__()
+                for registry in model.query.filter_by(created_by_id=self.id)]
+
 
 """
 Beginning of Blog related models
@@ -81,8 +96,9 @@ articles_tags = db.Table('articles_tags',
                          )
 
 
-class Article(CustomModelMixin, Model):
+class Article(UniqueSlugMixin, CustomModelMixin, Model):
     __tablename__ = 'articles'
+    cache_lookups = True
 
     title = Column(db.String(100), nullable=False)
     slug = Column(db.String(100), nullable=False, unique=True)
@@ -110,8 +126,11 @@ class Article(CustomModelMixin, Model):
         return self.save()
 
 
-class Tag(CustomModelMixin, Model):
+class Tag(UniqueSlugMixin, CustomModelMixin, Model):
     __tablename__ = 'tags'
+    __table_args__ = (
+        db.UniqueConstraint('slug', name='uq_tags_slug'),
+    )
 
     name = Column(db.String(50), nullable=False, unique=True)
     slug = Column(db.String(50), nullable=False)
@@ -134,7 +153,7 @@ Classes for the product/inventory management section
 """
 
 
-class Category(CustomModelMixin, Model):
+class Category(UniqueSlugMixin, CustomModelMixin, Model):
     __tablename__ = 'categories'
 
     name = Column(db.String(100), nullable=False, unique=True)
@@ -149,8 +168,13 @@ class Category(CustomModelMixin, Model):
         return self.name
 
 
-class Product(CustomModelMixin, Model):
+class Product(UniqueSlugMixin, CustomModelMixin, Model):
     __tablename__ = 'products'
+    __table_args__ = (
+        db.Index('ix_products_is_available_is_bundle', 'is_available', 'is_bundle'),
+        {'extend_existing': True},
+    )
+    cache_lookups = True
 
     name = Column(db.String(100), nullable=False)
     slug = Column(db.String(100), nullable=False, unique=True)
@@ -160,6 +184,8 @@ class Product(CustomModelMixin, Model):
     price = Column(db.Float, nullable=False)
     is_available = Column(db.Boolean, default=True)
     is_bundle = Column(db.Boolean, default=False)
+    # path of the main product image, maintained by ProductImage events
+    main_image_path = Column(db.Text, nullable=True)
     created_by_id = reference_col("user", nullable=True)
     date_created = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
 
@@ -201,7 +227,7 @@ class Product(CustomModelMixin, Model):
             'name': self.name,
             'slug': self.slug,
             'description': self.description,
-            'image': self.main_image.get_url
+            'image': self.main_image_path
         }
 
 
@@ -232,6 +258,22 @@ class ProductImage(CustomModelMixin, Model):
         """Represent instance as a string."""
         return self.name
 
+    @staticmethod
+    def refresh_main_image_path(connection, product_id):
+        """Copy the path of the main (or else first) image of a product onto the product row"""
+        images, products = ProductImage.__table__, Product.__table__
+        path = select([images.c.name]).where(images.c.product_id == product_id).\
+            order_by(images.c.is_main_image.desc(), images.c.id.asc()).limit(1).as_scalar()
+        connection.execute(products.update().where(products.c.id == product_id).values(main_image_path=path))
+        model_cache.invalidate_model(Product)
+
+
+@listens_for(ProductImage, 'after_insert')
+@listens_for(ProductImage, 'after_update')
+@listens_for(ProductImage, 'after_delete')
+def update_main_image_path(mapper, connection, target):
+    ProductImage.refresh_main_image_path(connection, target.product_id)
+
 
 class Discount(CustomModelMixin, Model):
     __tablename__ = 'discounts'
@@ -255,17 +297,93 @@ class Discount(CustomModelMixin, Model):
         return (self.percentage/100) * price
 
 
-class RegistryBase(CustomModelMixin, Model):
+class RegistryType(Model):
+    """Lookup table of the registry type codes stored in the registry_type columns"""
+    __tablename__ = 'registry_types'
+
+    id = Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    name = Column(db.String(50), unique=True, nullable=False)
+
+    def __str__(self):
+        return self.name
+
+
+@listens_for(RegistryType.__table__, 'after_create')
+def insert_registry_types(target, connection, **kw):
+    connection.execute(target.insert(), [{'id': x.type_code, 'name': x.__name__.lower()}
+                                         for x in RegistryBase.__subclasses__()])
+
+
+class RegistryBase(UniqueSlugMixin, CustomModelMixin, Model):
     __abstract__ = True
+    cache_lookups = True
+    # code stored in the registry_type column of associated rows, see RegistryType
+    type_code = None
 
-    slug = Column(db.String(100), nullable=True)
+    slug = Column(db.String(100), nullable=True, unique=True, index=True)
     date_created = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
     event_date = Column(db.Date, nullable=True)
     is_active = Column(db.Boolean, default=True)
 
+    # aggregates kept up to date with adjust_aggregates, rebuilt by `manage.py repair_registry_aggregates`
+    product_count = Column(db.Integer, nullable=False, default=0, server_default='0')
+    purchased_count = Column(db.Integer, nullable=False, default=0, server_default='0')
+    total_donated = Column(db.Float, nullable=False, default=0, server_default='0')
+    total_ordered = Column(db.Float, nullable=False, default=0, server_default='0')
+
+    # columns tokenized into the registry search index
+    search_fields = ('hashtag', 'slug')
+
     @property
     def product_ids(self):
-        return [x.id for x in self.products]
+        return [x.product_id for x in self.products]
+
+    @classmethod
+    def with_page_data(cls):
+        """Query that eager loads the delivery address and products (with their category) of a registry"""
+        return cls.query.options(
+            joinedload(cls.address),
+            selectinload(cls.products).joinedload(RegistryProducts.product).joinedload(Product.category))
+
+    def generate_slug(self):
+        """Claim the hashtag (without the #) as slug, flushing the registry"""
+        return self.allocate_slug(self.hashtag[1:].lower())
+
+    @classmethod
+    def for_type_code(cls, type_code):
+        model = next((x for x in cls.__subclasses__() if x.type_code == type_code), None)
+        if model is None:
+            raise ValueError(f'Unknown registry type code: {type_code!r}')
+        return model
+
+    @classmethod
+    def adjust_aggregates(cls, connection, registry_id, **deltas):
+        """Add deltas to aggregate columns in a single UPDATE, e.g. adjust_aggregates(conn, 1, product_count=-2)"""
+        deltas = {column: delta for column, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        table = cls.__table__
+        connection.execute(table.update().where(table.c.id == registry_id).
+                           values({table.c[column]: table.c[column] + delta for column, delta in deltas.items()}))
+        model_cache.invalidate_model(cls)
+
+    @property
+    def search_tokens(self):
+        return tokenize(*[getattr(self, field) for field in self.search_fields])
+
+    @classmethod
+    def search(cls, term):
+        ranked = RegistrySearch.ranked(term, registry_type=cls.type_code).subquery()
+        return cls.query.join(ranked, cls.id == ranked.c.registry_id).filter(cls.is_active.is_(True)).\
+            order_by(ranked.c.rank.desc(), cls.date_created.desc())
+
+    @declared_attr
+    def __table_args__(cls):
+        # serves the keyset pagination of active registries
+        return (
+            db.Index(f'ix_{cls.__tablename__}_is_active_date_created', 'is_active', 'date_created', 'id'),
+            {'extend_existing': True},
+        )
 
     @declared_attr
     def created_by_id(cls):
@@ -278,6 +396,7 @@ class RegistryBase(CustomModelMixin, Model):
 
 class WeddingRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
     __tablename__ = 'wedding_registries'
+    type_code = 1
 
     bride_first_name = Column(db.String(100), nullable=False)
     bride_last_name = Column(db.String(100), nullable=False)
@@ -288,6 +407,8 @@ class WeddingRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
     image = Column(db.Text, nullable=True)
     fund = Column(db.Float, nullable=True)
 
+    search_fields = ('bride_first_name', 'bride_last_name', 'groom_first_name', 'groom_last_name', 'hashtag', 'slug')
+
     admin_created_id = relationship("User")
     created_by = relationship("User", backref="weddings", primaryjoin="WeddingRegistry.created_by_id==User.id")
 
@@ -316,18 +437,6 @@ class WeddingRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
             return True
         return 'img/random/default_wedding.jpg'
 
-    @classmethod
-    def search(cls, term):
-        return cls.query.filter(cls.is_active.is_(True)).\
-            filter((cls.bride_first_name.ilike(term)) | (cls.bride_last_name.ilike(term)) |
-                   (cls.groom_first_name.ilike(term)) | (cls.groom_last_name.ilike(term)) | (cls.hashtag.ilike(term))
-                   | (cls.slug.ilike(term)))
-
-    def unique_slug(self, slug):
-        if self.query.filter_by(slug=slug).first():
-            return f"{slug}-{str(uuid.uuid4()).split('-')[0]}"
-        return False
-
     def generate_hashtag(self):
         # check if hashtag has been provided
         if not self.hashtag:
@@ -337,16 +446,10 @@ class WeddingRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
         if self.hashtag[0] != '#':
             self.hashtag = f'#{self.hashtag}'
 
-    def generate_slug(self):
-        # strip hashtag
-        slug = self.hashtag[1:]
-        # check if exists in database
-        check = self.unique_slug(slug)  # if it exists, add uuid
-        self.slug = check.lower() if check else slug.lower()
-
 
 class BabyShowerRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
     __tablename__ = 'baby_shower_registries'
+    type_code = 2
 
     baby_name = Column(db.String(100), nullable=False)
     parents_name = Column(db.String(200), nullable=False)
@@ -354,6 +457,8 @@ class BabyShowerRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
     message = Column(db.Text, nullable=True)
     image = Column(db.Text, nullable=True)
 
+    search_fields = ('baby_name', 'parents_name', 'hashtag', 'slug')
+
     admin_created_id = relationship("User")
     created_by = relationship("User", backref="baby_showers", primaryjoin="BabyShowerRegistry.created_by_id==User.id")
 
@@ -374,17 +479,6 @@ class BabyShowerRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
             return True
         return 'img/random/default_baby.jpg'
 
-    @classmethod
-    def search(cls, term):
-        return cls.query.filter(cls.is_active.is_(True)).\
-            filter((cls.baby_name.ilike(term)) | (cls.parents_name.ilike(term)) | (cls.hashtag.ilike(term))
-                   | (cls.slug.ilike(term)))
-
-    def unique_slug(self, slug):
-        if self.query.filter_by(slug=slug).first():
-            return f"{slug}-{str(uuid.uuid4()).split('-')[0]}"
-        return False
-
     def generate_hashtag(self):
         # check if hashtag has been provided
         if not self.hashtag:
@@ -394,16 +488,10 @@ class BabyShowerRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
         if self.hashtag[0] != '#':
             self.hashtag = f'#{self.hashtag}'
 
-    def generate_slug(self):
-        # strip hashtag
-        slug = self.hashtag[1:]
-        # check if exists in database
-        check = self.unique_slug(slug)  # if it exists, add uuid
-        self.slug = check.lower() if check else slug.lower()
-
 
 class BridalShowerRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
     __tablename__ = 'bridal_shower_registries'
+    type_code = 3
 
     first_name = Column(db.String(100), nullable=False)
     last_name = Column(db.String(100), nullable=False)
@@ -411,6 +499,8 @@ class BridalShowerRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
     message = Column(db.Text, nullable=True)
     image = Column(db.Text, nullable=True)
 
+    search_fields = ('first_name', 'last_name', 'hashtag', 'slug')
+
     admin_created_id = relationship("User")
     created_by = relationship("User", backref="bridal_showers", primaryjoin="BridalShowerRegistry.created_by_id==User.id")
 
@@ -431,17 +521,6 @@ class BridalShowerRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
             return True
         return 'img/random/default_bridal_shower.jpeg'
 
-    @classmethod
-    def search(cls, term):
-        return cls.query.filter(cls.is_active.is_(True)).\
-            filter((cls.first_name.ilike(term)) | (cls.last_name.ilike(term)) | (cls.hashtag.ilike(term))
-                   | (cls.slug.ilike(term)))
-
-    def unique_slug(self, slug):
-        if self.query.filter_by(slug=slug).first():
-            return f"{slug}-{str(uuid.uuid4()).split('-')[0]}"
-        return False
-
     def generate_hashtag(self):
         # check if hashtag has been provided
         if not self.hashtag:
@@ -451,16 +530,10 @@ class BridalShowerRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
         if self.hashtag[0] != '#':
             self.hashtag = f'#{self.hashtag}'
 
-    def generate_slug(self):
-        # strip hashtag
-        slug = self.hashtag[1:]
-        # check if exists in database
-        check = self.unique_slug(slug)  # if it exists, add uuid
-        self.slug = check.lower() if check else slug.lower()
-
 
 class BirthdayRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
     __tablename__ = 'birthday_registries'
+    type_code = 4
 
     first_name = Column(db.String(100), nullable=False)
     last_name = Column(db.String(100), nullable=False)
@@ -468,6 +541,8 @@ class BirthdayRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
     message = Column(db.Text, nullable=True)
     image = Column(db.Text, nullable=True)
 
+    search_fields = ('first_name', 'last_name', 'hashtag', 'slug')
+
     admin_created_id = relationship("User")
     created_by = relationship("User", backref="birthdays", primaryjoin="BirthdayRegistry.created_by_id==User.id")
 
@@ -488,17 +563,6 @@ class BirthdayRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
             return True
         return 'img/random/default_birthday.jpg'
 
-    @classmethod
-    def search(cls, term):
-        return cls.query.filter(cls.is_active.is_(True)).\
-            filter((cls.first_name.ilike(term)) | (cls.last_name.ilike(term)) | (cls.hashtag.ilike(term))
-                   | (cls.slug.ilike(term)))
-
-    def unique_slug(self, slug):
-        if self.query.filter_by(slug=slug).first():
-            return f"{slug}-{str(uuid.uuid4()).split('-')[0]}"
-        return False
-
     def generate_hashtag(self):
         # check if hashtag has been provided
         if not self.hashtag:
@@ -508,30 +572,150 @@ class BirthdayRegistry(HasOrders, HasProducts, HasAddress, RegistryBase):
         if self.hashtag[0] != '#':
             self.hashtag = f'#{self.hashtag}'
 
-    def generate_slug(self):
-        # strip hashtag
-        slug = self.hashtag[1:]
-        # check if exists in database
-        check = self.unique_slug(slug)  # if it exists, add uuid
-        self.slug = check.lower() if check else slug.lower()
+
+class RegistrySearch(CustomModelMixin, Model):
+    """Denormalized search entry for a registry of any type, kept in sync by mapper events"""
+    __tablename__ = 'registry_search'
+    __table_args__ = (
+        db.UniqueConstraint('registry_type', 'registry_id', name='uq_registry_search_registry'),
+    )
+
+    registry_type = Column(db.SmallInteger, db.ForeignKey('registry_types.id'), nullable=False)
+    registry_id = Column(db.Integer, nullable=False)
+    slug = Column(db.String(100), nullable=True)
+    is_active = Column(db.Boolean, default=True)
+    date_created = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+    @classmethod
+    def ranked(cls, term, registry_type=None):
+        """Query of (registry_type, registry_id, rank) for active registries matching any token of term"""
+        tokens = tokenize(term)
+        query = db.session.query(cls.registry_type, cls.registry_id, func.count(RegistrySearchToken.id).label('rank')).\
+            join(RegistrySearchToken, RegistrySearchToken.search_id == cls.id).\
+            filter(cls.is_active.is_(True))
+        if registry_type:
+            query = query.filter(cls.registry_type == registry_type)
+        if not tokens:
+            query = query.filter(false())
+        else:
+            # prefix matches can use the index on token, unlike '%term%'
+            query = query.filter(or_(*[RegistrySearchToken.token.like(f'{token}%') for token in tokens]))
+        return query.group_by(cls.id, cls.registry_type, cls.registry_id, cls.date_created)
+
+    @classmethod
+    def search(cls, term, limit=20):
+        """Search every registry type at once, returning registries ordered by rank"""
+        rows = cls.ranked(term).order_by(desc('rank'), cls.date_created.desc()).limit(limit).all()
+
+        ids = {}
+        for row in rows:
+            ids.setdefault(row.registry_type, []).append(row.registry_id)
+        loaded = {}
+        for registry_type, registry_ids in ids.items():
+            model = RegistryBase.for_type_code(registry_type)
+            for registry in model.query.filter(model.id.in_(registry_ids)):
+                loaded[(registry_type, registry.id)] = registry
+        return [loaded[key] for key in ((x.registry_type, x.registry_id) for x in rows) if key in loaded]
+
+    @classmethod
+    def index(cls, connection, registry):
+        """Insert or refresh the search entry of a registry using the flush connection"""
+        search, tokens = cls.__table__, RegistrySearchToken.__table__
+        registry_type = registry.type_code
+        values = {'slug': registry.slug, 'is_active': registry.is_active, 'date_created': registry.date_created}
+
+        search_id = connection.execute(
+            select([search.c.id]).where(and_(search.c.registry_type == registry_type,
+                                             search.c.registry_id == registry.id))).scalar()
+        if search_id is None:
+            result = connection.execute(search.insert().values(registry_type=registry_type,
+                                                               registry_id=registry.id, **values))
+            search_id = result.inserted_primary_key[0]
+        else:
+            connection.execute(search.update().where(search.c.id == search_id).values(**values))
+            connection.execute(tokens.delete().where(tokens.c.search_id == search_id))
+
+        rows = [{'search_id': search_id, 'token': token} for token in registry.search_tokens]
+        if rows:
+            connection.execute(tokens.insert(), rows)
+
+    @classmethod
+    def unindex(cls, connection, registry):
+        search, tokens = cls.__table__, RegistrySearchToken.__table__
+        condition = and_(search.c.registry_type == registry.type_code,
+                         search.c.registry_id == registry.id)
+        connection.execute(tokens.delete().where(tokens.c.search_id.in_(select([search.c.id]).where(condition))))
+        connection.execute(search.delete().where(condition))
+
+
+class RegistrySearchToken(CustomModelMixin, Model):
+    __tablename__ = 'registry_search_tokens'
+
+    search_id = reference_col("registry_search", nullable=False, column_kwargs={'index': True})
+    token = Column(db.String(100), nullable=False, index=True)
+
+
+@listens_for(RegistryBase, 'after_insert', propagate=True)
+def index_registry(mapper, connection, target):
+    RegistrySearch.index(connection, target)
+
+
+@listens_for(RegistryBase, 'after_update', propagate=True)
+def reindex_registry(mapper, connection, target):
+    state = db.inspect(target)
+    fields = set(target.search_fields) | {'is_active', 'slug'}
+    if any(state.attrs[field].history.has_changes() for field in fields):
+        RegistrySearch.index(connection, target)
+
+
+@listens_for(RegistryBase, 'after_delete', propagate=True)
+def unindex_registry(mapper, connection, target):
+    RegistrySearch.unindex(connection, target)
 
 
 class RegistryProducts(CustomModelMixin, Model):
     __tablename__ = 'registry_products'
+    __table_args__ = (
+        db.Index('ix_registry_products_registry', 'registry_type', 'registry_id'),
+        {'extend_existing': True},
+    )
 
     product_id = reference_col("products", nullable=False)
     has_been_purchased = Column(db.Boolean, default=False)
-    registry_type = Column(db.Unicode(255))
+    registry_type = Column(db.SmallInteger, db.ForeignKey('registry_types.id'))
     registry_id = Column(db.Integer, nullable=False)
 
     product = relationship("Product", backref=backref("registry_products", cascade="all, delete-orphan"))
 
+    @classmethod
+    def with_product_data(cls):
+        """Query that eager loads the product"""
+        return cls.query.options(joinedload(cls.product))
+
     def __str__(self):
         return self.product.name
 
 
+@listens_for(db.session, 'after_flush')
+def count_registry_products(session, flush_context):
+    """Apply the registry products added or removed by a flush to their registry's counts"""
+    deltas = {}
+    for instance, sign in [(x, 1) for x in session.new] + [(x, -1) for x in session.deleted]:
+        if isinstance(instance, RegistryProducts):
+            counts = deltas.setdefault((instance.registry_type, instance.registry_id), {'product_count': 0,
+                                                                                        'purchased_count': 0})
+            counts['product_count'] += sign
+            counts['purchased_count'] += sign if instance.has_been_purchased else 0
+    for (registry_type, registry_id), counts in deltas.items():
+        RegistryBase.for_type_code(registry_type).adjust_aggregates(session.connection(), registry_id, **counts)
+
+
 class RegistryDeliveryAddress(CustomModelMixin, Model):
     __tablename__ = 'registry_delivery_addresses'
+    __table_args__ = (
+        db.Index('ix_registry_delivery_addresses_registry', 'registry_type', 'registry_id'),
+        {'extend_existing': True},
+    )
 
     full_name = Column(db.String(100), nullable=False)
     phone_number = db.Column(db.String(50), nullable=True)
@@ -540,7 +724,7 @@ class RegistryDeliveryAddress(CustomModelMixin, Model):
     state = Column(db.String(50), nullable=False)
     additional_info = Column(db.Text, nullable=True)
 
-    registry_type = Column(db.Unicode(255))
+    registry_type = Column(db.SmallInteger, db.ForeignKey('registry_types.id'))
     registry_id = Column(db.Integer, nullable=False)
 
 
@@ -568,12 +752,99 @@ class Transaction(CustomModelMixin, Model):
     discount_id = reference_col("discounts", nullable=True)
     date_created = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
     date_paid = Column(db.DateTime, nullable=True)
-    payment_txn_number = Column(db.String(255), nullable=True)
+    payment_txn_number = Column(db.String(255), nullable=True, index=True)
 
     discount = relationship("Discount")
 
     def generate_txn_number(self):
-        self.txn_no = f"TXN{dt.date.today().strftime('%Y%m%d')}00000{self.id}"
+        """Assign the transaction number before insert, so the row is written once"""
+        self.txn_no = f"TXN{dt.date.today().strftime('%Y%m%d')}00000{number_allocator.next('transactions')}"
+
+    def mark_paid(self):
+        """Mark the transaction paid and add it to the aggregates of its registries, once.
+
+        Returns False if it had already been marked paid, e.g. by the webhook.
+        """
+        with unit_of_work() as session:
+            paid = Transaction.query.filter(Transaction.id == self.id, Transaction.payment_status != 'paid').\
+                update({'payment_status': 'paid', 'date_paid': dt.datetime.now()}, synchronize_session=False)
+            session.expire(self, ['payment_status', 'date_paid'])
+            if not paid:
+                return False
+
+            connection = session.connection()
+            if self.payment_txn_number:
+                ProcessedPayment.record(connection, [(self.id, self.payment_txn_number)])
+            for donation in self.donations:
+                WeddingRegistry.adjust_aggregates(connection, donation.registry_id, total_donated=donation.amount)
+
+            items = OrderItem.query.filter(OrderItem.order_id.in_([x.id for x in self.orders])).all() \
+                if self.orders else []
+            for order in self.orders:
+                order_items = [x for x in items if x.order_id == order.id]
+                purchased = RegistryProducts.query.\
+                    filter(RegistryProducts.id.in_([x.reg_product_id for x in order_items]),
+                           RegistryProducts.has_been_purchased.isnot(True)).\
+                    update({'has_been_purchased': True}, synchronize_session=False) if order_items else 0
+                RegistryBase.for_type_code(order.registry_type).adjust_aggregates(
+                    connection, order.registry_id, purchased_count=purchased,
+                    total_ordered=sum(x.total_price for x in order_items))
+        return True
+
+    @classmethod
+    def mark_paid_many(cls, ids):
+        """mark_paid for many transactions with one UPDATE per table, returning how many became paid.
+
+        Registry aggregates get one UPDATE per registry. If another process marks one of
+        the transactions paid in the meantime the batch is rolled back to a savepoint and
+        the transactions are marked one at a time instead, so no payment is counted twice.
+        """
+        with unit_of_work() as session:
+            references = session.query(cls.id, cls.payment_txn_number).\
+                filter(cls.id.in_(ids), cls.payment_status != 'paid').with_for_update().all()
+            ids = [x.id for x in references]
+            if not ids:
+                return 0
+            savepoint = session.begin_nested()
+            paid = cls.query.filter(cls.id.in_(ids), cls.payment_status != 'paid').\
+                update({'payment_status': 'paid', 'date_paid': dt.datetime.now()}, synchronize_session=False)
+            if paid != len(ids):
+                savepoint.rollback()
+                return sum(cls.query.get(x).mark_paid() for x in ids)
+
+            deltas = {}
+            for registry_id, amount in session.query(Donation.registry_id, Donation.amount).\
+                    filter(Donation.transaction_id.in_(ids)):
+                deltas.setdefault((WeddingRegistry.type_code, registry_id), Counter())['total_donated'] += amount
+
+            items = session.query(Order.registry_type, Order.registry_id, OrderItem.reg_product_id,
+                                  OrderItem.total_price).join(OrderItem, OrderItem.order_id == Order.id).\
+                filter(Order.transaction_id.in_(ids)).all()
+            for registry_type, registry_id, reg_product_id, total_price in items:
+                deltas.setdefault((registry_type, registry_id), Counter())['total_ordered'] += total_price
+
+            purchased = session.query(RegistryProducts.id, RegistryProducts.registry_type,
+                                      RegistryProducts.registry_id).\
+                filter(RegistryProducts.id.in_({x.reg_product_id for x in items}),
+                       RegistryProducts.has_been_purchased.isnot(True)).all() if items else []
+            if purchased:
+                RegistryProducts.query.filter(RegistryProducts.id.in_([x.id for x in purchased])).\
+                    update({'has_been_purchased': True}, synchronize_session=False)
+            for reg_product_id, registry_type, registry_id in purchased:
+                deltas.setdefault((registry_type, registry_id), Counter())['purchased_count'] += 1
+
+            connection = session.connection()
+            ProcessedPayment.record(connection, [x for x in references if x.payment_txn_number])
+            for (registry_type, registry_id), registry_deltas in deltas.items():
+                RegistryBase.for_type_code(registry_type).adjust_aggregates(connection, registry_id,
+                                                                            **registry_deltas)
+            savepoint.commit()
+        return paid
+
+    @classmethod
+    def get_by_reference(cls, reference):
+        """The transaction paid with Paystack reference"""
+        return cls.query.filter_by(payment_txn_number=reference).first()
 
     @property
     def get_amount_paid(self):
@@ -607,18 +878,23 @@ class Donation(CustomModelMixin, Model):
 
 class Order(CustomModelMixin, Model):
     __tablename__ = 'orders'
+    __table_args__ = (
+        db.Index('ix_orders_transaction_registry', 'transaction_id', 'registry_type', 'registry_id'),
+        {'extend_existing': True},
+    )
 
     order_number = Column(db.String(255), unique=True)
     transaction_id = reference_col("transactions", nullable=False)
     status = Column(ChoiceType(STATUS, impl=db.String()))
     date_created = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
-    registry_type = Column(db.Unicode(255))
+    registry_type = Column(db.SmallInteger, db.ForeignKey('registry_types.id'))
     registry_id = Column(db.Integer, nullable=False)
 
     transaction = relationship("Transaction", backref=backref("orders", uselist=True))
 
     def generate_order_number(self):
-        self.order_number = f"ORD{dt.date.today().strftime('%Y%m%d')}00000{self.id}"
+        """Assign the order number before insert, so the row is written once"""
+        self.order_number = f"ORD{dt.date.today().strftime('%Y%m%d')}00000{number_allocator.next('orders')}"
 
 
 class OrderItem(CustomModelMixin, Model):
@@ -632,3 +908,223 @@ class OrderItem(CustomModelMixin, Model):
 
     order = relationship("Order")
     registry_product = relationship("RegistryProducts")
+
+
+class Cart(CustomModelMixin, Model):
+    """Server-side shopping cart, referenced by ``cart_id`` in the visitor's session.
+
+    The totals are running sums kept in step by ``add``, ``set_quantity`` and ``remove``,
+    each of which only touches the changed line, so no operation loops over the cart.
+    Each of them first locks the cart row, so concurrent edits of one cart cannot
+    overwrite each other's totals.
+    """
+    __tablename__ = 'carts'
+
+    date_created = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    date_updated = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow, onupdate=dt.datetime.utcnow,
+                          index=True)
+    total_quantity = Column(db.Integer, nullable=False, default=0, server_default='0')
+    total_price = Column(db.Float, nullable=False, default=0, server_default='0')
+    discount_id = reference_col("discounts", nullable=True)
+    discount_amount = Column(db.Float, nullable=False, default=0, server_default='0')
+    # bumped with every change under the row lock, and part of the rendered cart's cache key
+    version = Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    items = relationship("CartItem", backref="cart", cascade="all, delete-orphan")
+    discount = relationship("Discount")
+
+    @property
+    def discounted_price(self):
+        return self.total_price - self.discount_amount
+
+    def lock(self):
+        """Reload the cart under a row lock held until commit, so concurrent edits apply one after another"""
+        # changes not flushed yet would be overwritten by the reload
+        db.session.flush()
+        Cart.query.filter_by(id=self.id).with_for_update().populate_existing().one()
+
+    def line(self, reg_product_id):
+        return CartItem.query.filter_by(cart_id=self.id, reg_product_id=reg_product_id).\
+            with_for_update().populate_existing().first()
+
+    def add(self, reg_product_id, unit_price, quantity=1):
+        """Add quantity of a registry product at unit_price"""
+        self.lock()
+        line = self.line(reg_product_id)
+        if line is None:
+            line = CartItem(cart_id=self.id, reg_product_id=reg_product_id, unit_price=unit_price, quantity=0)
+            try:
+                with db.session.begin_nested():
+                    db.session.add(line)
+            except IntegrityError:
+                # the line was inserted by a request that did not wait for the cart lock
+                line = self.line(reg_product_id)
+        self._adjust(line, quantity)
+
+    def set_quantity(self, reg_product_id, quantity):
+        self.lock()
+        line = self.line(reg_product_id)
+        if line is None:
+            return
+        if quantity <= 0:
+            return self.remove(reg_product_id)
+        self._adjust(line, quantity - line.quantity)
+
+    def remove(self, reg_product_id):
+        self.lock()
+        line = self.line(reg_product_id)
+        if line is not None:
+            self.remove_line(line)
+
+    def remove_line(self, line):
+        self._adjust(line, -line.quantity)
+        db.session.delete(line)
+
+    def reprice_line(self, line, unit_price):
+        self.total_price = round(self.total_price + line.quantity * (unit_price - line.unit_price), 2)
+        line.unit_price = unit_price
+        self.version = (self.version or 0) + 1
+        self.recalculate_discount()
+
+    def _adjust(self, line, delta):
+        line.quantity = (line.quantity or 0) + delta
+        self.total_quantity = (self.total_quantity or 0) + delta
+        # rounded to kobo so float error cannot build up over many changes
+        self.total_price = round((self.total_price or 0) + delta * line.unit_price, 2)
+        self.version = (self.version or 0) + 1
+        self.recalculate_discount()
+
+    def apply_discount(self, discount):
+        self.lock()
+        self.discount = discount
+        self.version = (self.version or 0) + 1
+        self.recalculate_discount()
+
+    def recalculate_discount(self):
+        """Hook run after every change, so a percentage discount follows the cart total"""
+        if self.discount is not None and not self.discount.is_active:
+            self.discount = None
+        amount = self.discount.get_discount_amount(self.total_price) if self.discount else 0
+        self.discount_amount = round(min(amount, self.total_price), 2)
+
+    def check_totals(self):
+        """Compare the running totals with the cart lines, returning a list of mismatches"""
+        quantity, price = db.session.query(func.coalesce(func.sum(CartItem.quantity), 0),
+                                           func.coalesce(func.sum(CartItem.quantity * CartItem.unit_price), 0)).\
+            filter(CartItem.cart_id == self.id).one()
+        problems = []
+        if quantity != self.total_quantity:
+            problems.append(f'total_quantity is {self.total_quantity}, lines add up to {quantity}')
+        if abs(price - self.total_price) > 0.005:
+            problems.append(f'total_price is {self.total_price}, lines add up to {price}')
+        if self.discount_amount > self.total_price:
+            problems.append(f'discount_amount {self.discount_amount} exceeds total_price {self.total_price}')
+        return problems
+
+
+class CartItem(CustomModelMixin, Model):
+    __tablename__ = 'cart_items'
+    __table_args__ = (
+        db.UniqueConstraint('cart_id', 'reg_product_id', name='uq_cart_items_cart_product'),
+        {'extend_existing': True},
+    )
+
+    cart_id = reference_col("carts", nullable=False, foreign_key_kwargs={'ondelete': 'CASCADE'})
+    # removed with Cart.remove_line when the registry product is deleted, see remove_cart_lines
+    reg_product_id = reference_col("registry_products", nullable=False)
+    quantity = Column(db.Integer, nullable=False, default=1)
+    # price when the line was added, which the cart total is built from
+    unit_price = Column(db.Float, nullable=False)
+
+    registry_product = relationship("RegistryProducts")
+
+
+@listens_for(db.session, 'before_flush')
+def remove_cart_lines(session, flush_context, instances):
+    """Take registry products being deleted out of every cart holding them, keeping the cart totals"""
+    ids = [x.id for x in session.deleted if isinstance(x, RegistryProducts)]
+    if not ids:
+        return
+    # carts are locked before their lines, as in Cart.add; Cart.lock can't be used as it flushes
+    cart_ids = session.query(CartItem.cart_id).filter(CartItem.reg_product_id.in_(ids))
+    carts = session.query(Cart).filter(Cart.id.in_(cart_ids)).order_by(Cart.id).with_for_update().all()
+    lines = session.query(CartItem).filter(CartItem.reg_product_id.in_(ids)).order_by(CartItem.cart_id).\
+        with_for_update().all()
+    for line in lines:
+        if line not in session.deleted and line.cart in carts and line.cart not in session.deleted:
+            line.cart.remove_line(line)
+
+
+class ProcessedPayment(CustomModelMixin, Model):
+    """A payment reference whose transaction has been marked paid.
+
+    Written in the same database transaction as the payment, and unique by reference,
+    so repeated callbacks for it can be answered from this table alone.
+    """
+    __tablename__ = 'processed_payments'
+
+    reference = Column(db.String(255), nullable=False, unique=True)
+    transaction_id = reference_col("transactions", nullable=False)
+    date_processed = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+    @classmethod
+    def record(cls, connection, transactions):
+        """Insert a row for each (transaction id, reference) pair"""
+        if transactions:
+            now = dt.datetime.utcnow()
+            connection.execute(cls.__table__.insert(), [
+                {'transaction_id': transaction_id, 'reference': reference, 'date_processed': now}
+                for transaction_id, reference in transactions])
+
+    @classmethod
+    def exists(cls, reference):
+        return db.session.query(cls.query.filter_by(reference=reference).exists()).scalar()
+
+    def __str__(self):
+        return self.reference
+
+
+class PaymentEvent(CustomModelMixin, Model):
+    """A payment reference waiting to be verified by `manage.py verify_payments`.
+
+    Pending events are picked up once next_attempt_at has passed. A worker claims an
+    event by pushing next_attempt_at past its lease, so an event whose worker died is
+    picked up again when the lease runs out.
+    """
+    __tablename__ = 'payment_events'
+    __table_args__ = (
+        db.Index('ix_payment_events_status_next_attempt_at', 'status', 'next_attempt_at'),
+        {'extend_existing': True},
+    )
+
+    reference = Column(db.String(255), nullable=False, index=True)
+    # webhook or callback
+    source = Column(db.String(20), nullable=False)
+    # pending, done or failed
+    status = Column(db.String(20), nullable=False, default='pending')
+    attempts = Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    last_error = Column(db.Text, nullable=True)
+    date_created = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    date_processed = Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def enqueue(cls, reference, source):
+        """Queue reference for verification, unless an event for it is already pending"""
+        event = cls.query.filter_by(reference=reference, status='pending').first()
+        if event is None:
+            event = cls.create(reference=reference, source=source)
+        return event
+
+    @classmethod
+    def claim(cls, event_id, lease):
+        """Take the event for lease seconds, False if it isn't due or another worker took it"""
+        now = dt.datetime.utcnow()
+        claimed = cls.query.filter(cls.id == event_id, cls.status == 'pending', cls.next_attempt_at <= now).\
+            update({'next_attempt_at': now + dt.timedelta(seconds=lease), 'attempts': cls.attempts + 1},
+                   synchronize_session=False)
+        db.session.commit()
+        return bool(claimed)
+
+    def __str__(self):
+        return self.reference
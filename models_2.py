@@ -247,24 +247,12 @@ class Discount(CustomModelMixin, Model):
         return (self.percentage/100) * price
 
 
-class RegistryType(CustomModelMixin, Model):
-    __tablename__ = 'registry_types'
-
-    name = Column(db.String(100), nullable=False)
-    slug = Column(db.String(100), nullable=False, unique=True)
-    is_active = Column(db.Boolean, default=True)
-
-    def __str__(self):
-        return self.name
-
-
 class Registry(CustomModelMixin, Model):
     __tablename__ = 'registries'
 
     name = Column(db.String(100), nullable=False)
     slug = Column(db.String(100), nullable=False, unique=True)
     hashtag = Column(db.String(50), nullable=True)
-    registry_type_id = reference_col("registry_types", nullable=True)
     description = Column(db.Text, nullable=False)
     image = Column(db.Text, nullable=True)
     created_by_id = reference_col("user", nullable=True)
@@ -275,7 +263,6 @@ class Registry(CustomModelMixin, Model):
     created_by = relationship("User", backref="registries", primaryjoin="Registry.created_by_id==User.id")
     admin_created_by = relationship("User", primaryjoin="Registry.admin_created_id==User.id")
     products = relationship("Product", secondary="registry_products")
-    registry_type = relationship("RegistryType", backref="registries")
 
     @property
     def url(self):
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Verifies payment references with Paystack, off the request path.
+
+The webhook and payment callback only store a PaymentEvent. `manage.py verify_payments`
+runs a PaymentVerifier, which polls for due events and verifies them on a thread pool.
+Marking a transaction paid is idempotent, so an event processed twice, or duplicate
+events for one reference, never count a payment twice.
+
+`manage.py reconcile` re-checks old unpaid transactions whose callback never came.
+"""
+import datetime as dt
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from sqlalchemy.orm import Session
+from database import db
+from models import PaymentEvent, Transaction
+from payment import PaystackPay, PaystackError, processed_references
+
+
+class PaymentVerifier(object):
+
+    def __init__(self, app, workers=None, batch_size=None):
+        self.app = app
+        self.workers = workers or app.config.get('PAYMENT_WORKERS', 4)
+        self.batch_size = batch_size or app.config.get('PAYMENT_BATCH_SIZE', 100)
+        self.max_attempts = app.config.get('PAYMENT_MAX_ATTEMPTS', 8)
+        self.backoff = app.config.get('PAYMENT_RETRY_BACKOFF', 30)
+        self.max_backoff = app.config.get('PAYMENT_MAX_RETRY_BACKOFF', 3600)
+        self.lease = app.config.get('PAYMENT_EVENT_LEASE', 300)
+        self.poll_interval = app.config.get('PAYMENT_POLL_INTERVAL', 2)
+
+    def due_events(self):
+        with self.app.app_context():
+            return [x for x, in db.session.query(PaymentEvent.id).
+                    filter(PaymentEvent.status == 'pending', PaymentEvent.next_attempt_at <= dt.datetime.utcnow()).
+                    order_by(PaymentEvent.next_attempt_at).limit(self.batch_size)]
+
+    def run(self, once=False):
+        """Verify due events until interrupted, or until none are left when once is True.
+
+        Returns the number of events processed.
+        """
+        processed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                event_ids = self.due_events()
+                if not event_ids:
+                    if once:
+                        return processed
+                    time.sleep(self.poll_interval)
+                    continue
+                processed += sum(executor.map(self.process, event_ids))
+
+    def process(self, event_id):
+        """Verify one event, returning False if another worker had claimed it"""
+        with self.app.app_context():
+            if not PaymentEvent.claim(event_id, self.lease):
+                return False
+
+            event = PaymentEvent.query.get(event_id)
+            try:
+                error = self.verify(event.reference)
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.exception('Verifying payment %s failed', event.reference)
+                error = repr(e)
+
+            if error is None:
+                self.finish(event, 'done')
+            elif event.attempts >= self.max_attempts:
+                self.finish(event, 'failed', error)
+            else:
+                delay = min(self.backoff * 2 ** (event.attempts - 1), self.max_backoff)
+                PaymentEvent.query.filter_by(id=event.id).update({
+                    'next_attempt_at': dt.datetime.utcnow() + dt.timedelta(seconds=delay), 'last_error': error})
+                db.session.commit()
+            return True
+
+    @staticmethod
+    def verify(reference):
+        """Mark the transaction of reference paid if Paystack confirms it, None on success or the error"""
+        if processed_references.seen(reference):
+            return None
+
+        tran = Transaction.get_by_reference(reference)
+        if not tran:
+            return 'Reference code not found'
+        if tran.payment_status == 'paid':
+            return None
+
+        try:
+            status = PaystackPay().transaction_status(reference)
+        except PaystackError as e:
+            return str(e)
+        if status != 'success':
+            return f'Payment status is {status}'
+
+        tran.mark_paid()
+        processed_references.remember(reference)
+        return None
+
+    @staticmethod
+    def finish(event, status, error=None):
+        PaymentEvent.query.filter_by(id=event.id).update({
+            'status': status, 'last_error': error, 'date_processed': dt.datetime.utcnow()})
+        db.session.commit()
+
+
+def reconcile(app, min_age, workers=None, batch_size=None):
+    """Verify unpaid transactions older than min_age minutes and mark the confirmed ones paid.
+
+    Run inside an app context. Transactions are streamed with yield_per on a session of
+    their own, verified with Paystack in batches of batch_size on a bounded thread pool,
+    and every batch of confirmed payments is marked paid with Transaction.mark_paid_many.
+    Returns counts of the transactions checked, paid, still unpaid and those that could
+    not be verified.
+    """
+    workers = workers or app.config.get('PAYMENT_WORKERS', 4)
+    batch_size = batch_size or app.config.get('RECONCILE_BATCH_SIZE', 500)
+    cutoff = dt.datetime.utcnow() - dt.timedelta(minutes=min_age)
+
+    def status(reference):
+        with app.app_context():
+            try:
+                return PaystackPay().transaction_status(reference)
+            except PaystackError:
+                return None
+
+    counts = Counter()
+    # the stream keeps its cursor open while db.session commits each batch
+    stream = Session(bind=db.engine)
+    try:
+        transactions = stream.query(Transaction.id, Transaction.payment_txn_number).\
+            filter(Transaction.payment_status == 'unpaid', Transaction.payment_txn_number.isnot(None),
+                   Transaction.date_created < cutoff).\
+            order_by(Transaction.id).yield_per(batch_size)
+        if db.engine.dialect.name == 'sqlite':
+            # SQLite can't commit while another connection is still reading
+            transactions = transactions.all()
+        transactions = iter(transactions)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                batch = list(islice(transactions, batch_size))
+                if not batch:
+                    break
+                statuses = list(executor.map(status, [x.payment_txn_number for x in batch]))
+                paid = [x.id for x, s in zip(batch, statuses) if s == 'success']
+                counts['checked'] += len(batch)
+                counts['errors'] += statuses.count(None)
+                counts['unpaid'] += len(batch) - len(paid) - statuses.count(None)
+                if paid:
+                    counts['paid'] += Transaction.mark_paid_many(paid)
+    finally:
+        stream.close()
+    return counts
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for the parts of the Paystack API the shop uses.
+
+Run it with `manage.py paystack_simulator` and point PAYSTACK_BASE_URL at it to load test
+checkout, donations and payment verification without calling Paystack. Every API call
+waits for a configurable latency and fails with a 500 at a configurable rate. Paying at
+the authorization URL, or initializing with auto_pay on, sends a signed charge.success
+webhook to webhook_url, like Paystack does.
+"""
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import requests
+from flask import Flask, jsonify, redirect, request
+
+
+class Simulator(object):
+
+    def __init__(self, secret_key, latency=0.1, jitter=0.05, error_rate=0.0, failure_rate=0.0,
+                 webhook_url=None, auto_pay=False, currency='NGN'):
+        self.secret_key = secret_key
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.failure_rate = failure_rate
+        self.webhook_url = webhook_url
+        self.auto_pay = auto_pay
+        self.currency = currency
+        self.transactions = {}
+        self.counts = {'initialize': 0, 'verify': 0, 'errors': 0, 'webhooks': 0, 'webhook_errors': 0}
+        self._lock = threading.Lock()
+        self._webhooks = ThreadPoolExecutor(max_workers=4)
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def delay(self):
+        """Wait like a round trip to Paystack, True if the call should fail"""
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.error_rate:
+            self.count('errors')
+            return True
+        return False
+
+    def pay(self, reference):
+        """Settle a transaction as a customer would, then notify the webhook"""
+        transaction = self.transactions[reference]
+        if transaction['status'] == 'ongoing':
+            transaction['status'] = 'failed' if random.random() < self.failure_rate else 'success'
+            transaction['paid_at'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+            if transaction['status'] == 'success' and self.webhook_url:
+                self._webhooks.submit(self.send_webhook, transaction)
+
+    def send_webhook(self, transaction):
+        body = json.dumps({'event': 'charge.success', 'data': transaction}).encode()
+        signature = hmac.new(self.secret_key.encode(), body, hashlib.sha512).hexdigest()
+        try:
+            requests.post(self.webhook_url, data=body, timeout=10,
+                          headers={'Content-Type': 'application/json', 'x-paystack-signature': signature})
+            self.count('webhooks')
+        except requests.RequestException:
+            self.count('webhook_errors')
+
+
+def create_simulator(secret_key, **options):
+    """The simulator as a WSGI app, see Simulator for the options"""
+    app = Flask(__name__)
+    simulator = app.simulator = Simulator(secret_key, **options)
+
+    def error(message, status):
+        return jsonify({'status': False, 'message': message}), status
+
+    @app.before_request
+    def authorize():
+        if request.path.startswith('/transaction/'):
+            if request.headers.get('Authorization') != f'Bearer {secret_key}':
+                return error('Invalid key', 401)
+
+    @app.route('/transaction/initialize', methods=['POST'])
+    def initialize():
+        simulator.count('initialize')
+        if simulator.delay():
+            return error('Simulated server error', 500)
+
+        payload = request.get_json(silent=True) or {}
+        if not payload.get('email') or not payload.get('amount'):
+            return error('Email and amount are required', 400)
+
+        reference = uuid.uuid4().hex[:12]
+        simulator.transactions[reference] = {
+            'reference': reference,
+            'amount': int(payload['amount']),
+            'currency': simulator.currency,
+            'status': 'ongoing',
+            'paid_at': None,
+            'customer': {'email': payload['email']},
+            'callback_url': payload.get('callback_url'),
+        }
+        if simulator.auto_pay:
+            simulator.pay(reference)
+        return jsonify({'status': True, 'message': 'Authorization URL created', 'data': {
+            'authorization_url': f'{request.url_root}checkout/{reference}',
+            'access_code': reference,
+            'reference': reference,
+        }})
+
+    @app.route('/transaction/verify/<reference>', methods=['GET'])
+    def verify(reference):
+        simulator.count('verify')
+        if simulator.delay():
+            return error('Simulated server error', 500)
+
+        transaction = simulator.transactions.get(reference)
+        if not transaction:
+            return error('Transaction reference not found', 400)
+        return jsonify({'status': True, 'message': 'Verification successful', 'data': transaction})
+
+    @app.route('/checkout/<reference>', methods=['GET'])
+    def checkout(reference):
+        """The payment page: pays at once and returns to the callback URL"""
+        transaction = simulator.transactions.get(reference)
+        if not transaction:
+            return error('Transaction reference not found', 404)
+
+        simulator.pay(reference)
+        if transaction['callback_url']:
+            return redirect(f"{transaction['callback_url']}?{urlencode({'reference': reference})}")
+        return jsonify({'status': True, 'data': transaction})
+
+    @app.route('/simulator/stats', methods=['GET'])
+    def stats():
+        return jsonify(dict(simulator.counts, transactions=len(simulator.transactions)))
+
+    return app
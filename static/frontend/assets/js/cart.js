@@ -0,0 +1,104 @@
+/*global jQuery */
+(function($) {
+  "use strict";
+
+  /* ------------------  CART ------------------ */
+  // Add and remove cart lines through the JSON cart API without reloading the page.
+  // Every link keeps its plain href, which is followed whenever the request fails.
+
+  function formatMoney(value) {
+      return "NGN" + Number(value).toLocaleString("en-US", {minimumFractionDigits: 2, maximumFractionDigits: 2});
+  }
+
+  function escapeHtml(value) {
+      return $("<div>").text(value).html();
+  }
+
+  function renderHeader(cart) {
+      var $lines = $("[data-cart-lines]"),
+          staticUrl = $lines.data("static-url"),
+          removeUrl = $lines.data("remove-url");
+
+      $("[data-cart-count]").text(cart.total_quantity);
+      $("[data-cart-box]").toggle(cart.total_quantity > 0);
+      $lines.empty();
+      $.each(cart.items, function(i, item) {
+          $lines.append(
+              '<li>' +
+                  '<img class="img-fluid" src="' + staticUrl + escapeHtml(item.product.image) + '" alt="product" />' +
+                  '<div class="product-meta">' +
+                      '<h5 class="product-title">' + escapeHtml(item.product.name) + '</h5>' +
+                      '<p class="product-qunt">Quantity: ' + item.quantity + '</p>' +
+                      '<p class="product-price">' + formatMoney(item.total_price) + '</p>' +
+                  '</div>' +
+                  '<a class="cart-cancel" href="#" data-cart-remove="' + removeUrl + item.reg_product_id + '"><i class="lnr lnr-cross"></i></a>' +
+              '</li>'
+          );
+      });
+  }
+
+  function renderTotals(cart) {
+      $("[data-cart-subtotal]").text(formatMoney(cart.total_price));
+      $("[data-cart-discount]").text(formatMoney(cart.discount_amount));
+      $("[data-cart-total]").text(formatMoney(cart.discount_amount ? cart.discounted_price : cart.total_price));
+
+      // drop the rows of lines no longer in the cart, e.g. when removed from the header
+      var ids = $.map(cart.items, function(item) { return String(item.reg_product_id); });
+      $("[data-cart-line]").each(function() {
+          if ($.inArray(String($(this).data("cart-line")), ids) === -1) {
+              $(this).remove();
+          }
+      });
+  }
+
+  function render(cart) {
+      renderHeader(cart);
+      renderTotals(cart);
+      // the cart page shows its empty state on a fresh render
+      if (!cart.total_quantity && $("[data-cart-total]").length) {
+          window.location.reload();
+      }
+  }
+
+  $(document).on("click", "[data-cart-add]", function(e) {
+      var $link = $(this),
+          href = $link.attr("href");
+
+      e.preventDefault();
+      if ($link.hasClass("disabled")) {
+          return;
+      }
+      $link.addClass("disabled").attr("aria-disabled", "true");
+      $.ajax({
+          url: $link.data("cart-add"),
+          type: "POST",
+          contentType: "application/json",
+          data: JSON.stringify({reg_product_id: $link.data("product-id"), quantity: 1}),
+          dataType: "json"
+      }).done(function(cart) {
+          render(cart);
+          $link.addClass("added");
+      }).fail(function() {
+          window.location = href;
+      }).always(function() {
+          $link.removeClass("disabled").removeAttr("aria-disabled");
+      });
+  });
+
+  $(document).on("click", "[data-cart-remove]", function(e) {
+      var $link = $(this),
+          href = $link.attr("href");
+
+      e.preventDefault();
+      $.ajax({
+          url: $link.data("cart-remove"),
+          type: "DELETE",
+          dataType: "json"
+      }).done(render).fail(function() {
+          if (href && href !== "#") {
+              window.location = href;
+          }
+      });
+  });
+
+})(jQuery);
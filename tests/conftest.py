@@ -0,0 +1,57 @@
+import datetime as dt
+import os
+import sys
+import pytest
+
+# config.py reads the environment on import
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ.setdefault('PAYSTACK_SECRET_KEY', 'sk_test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app  # noqa: E402
+from database import db  # noqa: E402
+from frontend import frontend  # noqa: E402
+from models import Category, Product, RegistryDeliveryAddress, RegistryProducts, WeddingRegistry  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    flask_app.config.update(TESTING=True)
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    if 'frontend' not in app.blueprints:
+        app.register_blueprint(frontend)
+    return app.test_client()
+
+
+@pytest.fixture
+def products(app):
+    category = Category(name='Kitchen', slug='kitchen')
+    category.save()
+    products = []
+    for i in range(5):
+        product = Product(name=f'Product {i}', slug=f'product-{i}', category=category, description='<p>-</p>',
+                          price=1000.0 + i * 250.5)
+        product.save()
+        products.append(product)
+    return products
+
+
+@pytest.fixture
+def registry(products):
+    registry = WeddingRegistry(bride_first_name='Ada', bride_last_name='Obi', groom_first_name='Tunde',
+                               groom_last_name='Bello', event_date=dt.date(2030, 1, 1), message='-', fund=0)
+    registry.address = RegistryDeliveryAddress(full_name='Ada Obi', address='-', city='Lagos', state='Lagos')
+    registry.generate_hashtag()
+    registry.generate_slug()
+    registry.products.extend(RegistryProducts(product_id=x.id) for x in products)
+    registry.save()
+    return registry
@@ -0,0 +1,57 @@
+from flask import session
+from database import db
+from cart import cart_store
+from models import Cart, RegistryProducts
+
+
+def test_rendered_cart_follows_edits_made_elsewhere(app, registry):
+    first, second = registry.products[:2]
+    with app.test_request_context():
+        cart_store.add(first, 2)
+        assert list(cart_store.items()) == [str(first.id)]
+
+        # another request with the same cookie, or another worker, edits the cart
+        cart = Cart.query.get(session['cart_id'])
+        cart.add(second.id, second.product.price)
+        db.session.commit()
+        assert list(cart_store.items()) == [str(first.id), str(second.id)]
+
+        db.session.delete(RegistryProducts.query.get(first.id))
+        db.session.commit()
+        assert list(cart_store.items()) == [str(second.id)]
+
+
+def test_summary_totals_match_its_lines(app, registry):
+    first, second = registry.products[:2]
+    with app.test_request_context():
+        cart_store.add(first, 2)
+
+        # the session still carries the totals from before this edit
+        cart = Cart.query.get(session['cart_id'])
+        cart.add(second.id, second.product.price)
+        db.session.commit()
+
+        summary = cart_store.summary()
+        assert [x['reg_product_id'] for x in summary['items']] == [first.id, second.id]
+        assert summary['total_quantity'] == sum(x['quantity'] for x in summary['items']) == 3
+
+
+def test_api_add_rejects_quantities_over_the_maximum(app, client, registry):
+    product = registry.products[0]
+    limit = app.config['CART_MAX_QUANTITY']
+
+    response = client.post('/api/cart/items', json={'reg_product_id': product.id, 'quantity': limit + 1})
+    assert response.status_code == 400
+    response = client.post('/api/cart/items', json={'reg_product_id': product.id, 'quantity': limit})
+    assert response.status_code == 201
+    assert response.get_json()['total_quantity'] == limit
+
+
+def test_delete_route_only_matches_integer_ids(app, client, registry):
+    product = registry.products[0]
+    client.post('/api/cart/items', json={'reg_product_id': product.id})
+
+    assert b'could not be found' in client.get('/cart/delete/abc').data
+    assert len(client.get('/api/cart').get_json()['items']) == 1
+    assert client.get(f'/cart/delete/{product.id}').status_code == 302
+    assert client.get('/api/cart').get_json()['items'] == []
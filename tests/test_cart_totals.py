@@ -0,0 +1,99 @@
+import random
+from database import db
+from models import Cart, CartItem, Discount, RegistryProducts
+
+
+def recomputed(cart):
+    lines = CartItem.query.filter_by(cart_id=cart.id).all()
+    return sum(x.quantity for x in lines), round(sum(x.quantity * x.unit_price for x in lines), 2)
+
+
+def assert_totals(cart):
+    db.session.commit()
+    db.session.expire_all()
+    quantity, price = recomputed(cart)
+    assert cart.total_quantity == quantity
+    assert abs(cart.total_price - price) < 0.005
+    discount = cart.discount.get_discount_amount(price) if cart.discount else 0
+    assert abs(cart.discount_amount - min(discount, price)) < 0.005
+    assert cart.check_totals() == []
+
+
+def test_running_totals_follow_random_edits(registry):
+    products = list(registry.products)
+    discounts = [Discount(code='TEN', percentage=10), Discount(code='FLAT', amount=1500.0)]
+    db.session.add_all(discounts)
+    cart = Cart()
+    cart.save()
+
+    rand = random.Random(2019)
+    for _ in range(200):
+        product = rand.choice(products)
+        operation = rand.choice(['add', 'add', 'set_quantity', 'remove', 'reprice', 'discount'])
+        if operation == 'add':
+            cart.add(product.id, product.product.price, rand.randint(1, 3))
+        elif operation == 'set_quantity':
+            cart.set_quantity(product.id, rand.randint(0, 5))
+        elif operation == 'remove':
+            cart.remove(product.id)
+        elif operation == 'reprice':
+            line = cart.line(product.id)
+            if line is not None:
+                cart.reprice_line(line, round(rand.uniform(100, 5000), 2))
+        else:
+            cart.apply_discount(rand.choice(discounts + [None]))
+        assert_totals(cart)
+
+
+def test_set_quantity_and_remove(registry):
+    first, second = registry.products[:2]
+    cart = Cart()
+    cart.save()
+
+    cart.add(first.id, 1000.0, 2)
+    cart.add(second.id, 1250.5)
+    cart.add(first.id, 1000.0)
+    assert_totals(cart)
+    assert (cart.total_quantity, cart.total_price) == (4, 4250.5)
+
+    cart.set_quantity(first.id, 1)
+    assert_totals(cart)
+    assert (cart.total_quantity, cart.total_price) == (2, 2250.5)
+
+    cart.remove(second.id)
+    cart.set_quantity(first.id, 0)
+    assert_totals(cart)
+    assert (cart.total_quantity, cart.total_price, CartItem.query.count()) == (0, 0, 0)
+
+
+def test_discount_is_capped_and_dropped_when_deactivated(registry):
+    discount = Discount(code='BIG', amount=5000.0, is_active=True)
+    cart = Cart()
+    cart.save()
+
+    cart.add(registry.products[0].id, 1000.0)
+    cart.apply_discount(discount)
+    assert_totals(cart)
+    assert cart.discount_amount == 1000.0
+
+    discount.is_active = False
+    cart.add(registry.products[0].id, 1000.0)
+    assert_totals(cart)
+    assert cart.discount is None and cart.discount_amount == 0
+
+
+def test_deleting_a_registry_product_updates_the_carts_holding_it(registry):
+    first, second = registry.products[:2]
+    carts = [Cart(), Cart()]
+    for cart in carts:
+        cart.save()
+        cart.add(first.id, 1000.0, 2)
+        cart.add(second.id, 1250.5)
+    db.session.commit()
+
+    db.session.delete(RegistryProducts.query.get(first.id))
+    db.session.commit()
+
+    for cart in carts:
+        assert_totals(cart)
+        assert (cart.total_quantity, cart.total_price) == (1, 1250.5)
@@ -0,0 +1,33 @@
+from checkout import revalidate_cart
+from database import db
+from models import Cart, Discount
+
+
+def test_revalidate_cart_drops_purchased_products_and_expired_discounts(registry):
+    first, second, third = registry.products[:3]
+    discount = Discount(code='TEN', percentage=10, is_active=True)
+    cart = Cart()
+    cart.save()
+    cart.add(first.id, first.product.price, 2)
+    cart.add(second.id, second.product.price)
+    cart.add(third.id, 1.0)
+    cart.apply_discount(discount)
+    db.session.commit()
+
+    second.has_been_purchased = True
+    discount.is_active = False
+    db.session.commit()
+
+    items, changes = revalidate_cart(cart)
+    db.session.commit()
+
+    assert set(items) == {str(first.id), str(third.id)}
+    assert changes == [
+        f'{second.product.name} has already been bought from the registry and has been removed from your cart',
+        f'The price of {third.product.name} has changed to {third.product.price:,.2f}',
+        'The discount code TEN is no longer valid and has been removed',
+    ]
+    assert cart.total_quantity == 3
+    assert cart.total_price == round(2 * first.product.price + third.product.price, 2)
+    assert cart.discount is None and cart.discount_amount == 0
+    assert cart.check_totals() == []
@@ -0,0 +1,39 @@
+import hashlib
+import hmac
+import json
+import pytest
+from database import db
+from models import PaymentEvent, Transaction
+from payment import PaystackPay
+
+
+def post_event(client, event, secret_key):
+    body = json.dumps(event).encode()
+    headers = {'x-paystack-signature': hmac.new(secret_key.encode(), body, hashlib.sha512).hexdigest()}
+    return client.post('/cart/verify-payment-webhook', data=body, content_type='application/json', headers=headers)
+
+
+def test_unsigned_webhooks_are_refused(client):
+    event = {'event': 'charge.success', 'data': {'reference': 'ref1', 'amount': 50000, 'currency': 'NGN'}}
+    assert client.post('/cart/verify-payment-webhook?reference=ref1').status_code == 401
+    assert client.post('/cart/verify-payment-webhook', json=event).status_code == 401
+    assert post_event(client, event, 'not the secret key').status_code == 401
+    assert PaymentEvent.query.count() == 0
+
+
+def test_signed_webhook_marks_the_transaction_paid(app, client):
+    transaction = Transaction(txn_no='TXN1', first_name='Ada', last_name='Obi', email='ada@example.com',
+                              type='donation', payment_status='unpaid', total_amount=500.0, payment_txn_number='ref1')
+    db.session.add(transaction)
+    db.session.commit()
+
+    event = {'event': 'charge.success', 'data': {'reference': 'ref1', 'amount': 50000, 'currency': 'NGN'}}
+    assert post_event(client, event, app.config['PAYSTACK_SECRET_KEY']).status_code == 200
+    db.session.expire_all()
+    assert Transaction.query.get(transaction.id).payment_status == 'paid'
+
+
+def test_paystack_needs_a_secret_key(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAYSTACK_SECRET_KEY', None)
+    with pytest.raises(RuntimeError, match='PAYSTACK_SECRET_KEY'):
+        PaystackPay()
@@ -0,0 +1,75 @@
+import datetime as dt
+import threading
+import pytest
+from werkzeug.serving import make_server
+from database import db
+from models import Donation, Order, OrderItem, ProcessedPayment, Transaction, WeddingRegistry
+from payment_worker import reconcile
+from paystack_simulator import create_simulator
+
+
+@pytest.fixture
+def paystack(app):
+    """The Paystack simulator on a local port, with PAYSTACK_BASE_URL pointing at it"""
+    simulator = create_simulator(app.config['PAYSTACK_SECRET_KEY'], latency=0, jitter=0)
+    server = make_server('127.0.0.1', 0, simulator, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = app.config.get('PAYSTACK_BASE_URL')
+    app.config['PAYSTACK_BASE_URL'] = f'http://127.0.0.1:{server.server_port}'
+    yield simulator.simulator
+    app.config['PAYSTACK_BASE_URL'] = base_url
+    server.shutdown()
+    thread.join()
+
+
+def make_transaction(paystack, number, status, registry, product=None, age=dt.timedelta(hours=2)):
+    """An unpaid transaction for a donation, or an order of product, that Paystack reports as status"""
+    reference = f'ref{number}'
+    transaction = Transaction(txn_no=f'TXN{number}', first_name='Ada', last_name='Obi', email='ada@example.com',
+                              type='order' if product else 'donation', payment_status='unpaid', total_amount=500.0,
+                              payment_txn_number=reference, date_created=dt.datetime.utcnow() - age)
+    if product is None:
+        db.session.add(Donation(registry_id=registry.id, transaction=transaction, amount=500.0))
+    else:
+        order = Order(registry_type=WeddingRegistry.type_code, registry_id=registry.id, transaction=transaction,
+                      order_number=f'ORD{number}')
+        db.session.add(OrderItem(order=order, reg_product_id=product.id, quantity=1, unit_price=500.0,
+                                 total_price=500.0))
+    db.session.add(transaction)
+    if status is not None:
+        paystack.transactions[reference] = {'reference': reference, 'amount': 50000, 'currency': 'NGN',
+                                            'status': status}
+
+
+def test_reconcile_marks_confirmed_payments_paid_once(app, paystack, registry):
+    first, second = registry.products[:2]
+    make_transaction(paystack, 1, 'success', registry)
+    make_transaction(paystack, 2, 'success', registry, first)
+    make_transaction(paystack, 3, 'success', registry, first)
+    make_transaction(paystack, 4, 'abandoned', registry, second)
+    make_transaction(paystack, 5, 'failed', registry)
+    # unknown to Paystack, which answers 400
+    make_transaction(paystack, 6, None, registry)
+    # too recent to reconcile
+    make_transaction(paystack, 7, 'success', registry, second, age=dt.timedelta(minutes=5))
+    db.session.commit()
+
+    counts = reconcile(app, min_age=60, workers=2, batch_size=2)
+    assert counts == {'checked': 6, 'paid': 3, 'unpaid': 2, 'errors': 1}
+
+    db.session.expire_all()
+    paid = {x.payment_txn_number for x in Transaction.query.filter_by(payment_status='paid')}
+    assert paid == {'ref1', 'ref2', 'ref3'}
+    assert {x.reference for x in ProcessedPayment.query} == paid
+    registry = WeddingRegistry.query.get(registry.id)
+    assert (registry.total_donated, registry.total_ordered, registry.purchased_count) == (500.0, 1000.0, 1)
+    assert first.has_been_purchased and not second.has_been_purchased
+
+    counts = reconcile(app, min_age=60, workers=2, batch_size=2)
+    assert counts == {'checked': 3, 'unpaid': 2, 'errors': 1}
+
+    db.session.expire_all()
+    registry = WeddingRegistry.query.get(registry.id)
+    assert (registry.total_donated, registry.total_ordered, registry.purchased_count) == (500.0, 1000.0, 1)
+    assert Transaction.query.filter_by(payment_status='paid').count() == 3
@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy.exc import IntegrityError
+from database import db
+from models import Article, Category, Tag, WeddingRegistry
+
+
+class DatabaseError(Exception):
+    pass
+
+
+def integrity_error(message):
+    return IntegrityError('INSERT ...', {}, DatabaseError(message))
+
+
+def test_taken_slugs_get_a_suffix(app):
+    first, second = Tag(name='Kitchen'), Tag(name='Kitchens')
+    db.session.add(first)
+    assert first.allocate_slug('kitchen') == 'kitchen'
+    db.session.add(second)
+    assert second.allocate_slug('kitchen').startswith('kitchen-')
+    db.session.commit()
+    assert Tag.query.count() == 2
+
+
+def test_a_rejected_slug_rolls_back_only_its_record(app):
+    Category(name='Kitchen', slug='kitchen').save()
+    other = Category(name='Bedroom', slug='bedroom')
+    db.session.add(other)
+    category = Category(name='Kitchen 2')
+    assert category.allocate_slug('kitchen').startswith('kitchen-')
+    db.session.commit()
+    assert {x.slug for x in Category.query} == {'kitchen', 'bedroom', category.slug}
+
+
+@pytest.mark.parametrize('model, message, expected', [
+    (WeddingRegistry, 'UNIQUE constraint failed: wedding_registries.slug', True),
+    (WeddingRegistry, "(1062, \"Duplicate entry 'ada' for key 'ix_wedding_registries_slug'\")", True),
+    (WeddingRegistry, "(1062, \"Duplicate entry 'ada' for key 'wedding_registries.ix_wedding_registries_slug'\")",
+     True),
+    (WeddingRegistry, 'UNIQUE constraint failed: wedding_registries.hashtag', False),
+    (Tag, "(1062, \"Duplicate entry 'c' for key 'uq_tags_slug'\")", True),
+    (Article, "(1062, \"Duplicate entry 'news' for key 'slug'\")", True),
+    (Article, "(1062, \"Duplicate entry 'news-slug' for key 'title'\")", False),
+])
+def test_slug_collisions_are_told_apart_from_other_constraints(model, message, expected):
+    assert model.is_slug_collision(integrity_error(message)) is expected
@@ -2,6 +2,7 @@ import os
 from datetime import date
 import random
 import string
+import re
 
 
 def get_file_path():
@@ -41,3 +42,15 @@ def generate_random_string(length=6):
     """Generate a random string of fixed length """
     letters = string.ascii_letters + string.digits
     return ''.join(random.choice(letters) for i in range(length))
+
+
+def tokenize(*values):
+    """Split values into lowercase alphanumeric tokens for the search index"""
+    tokens = []
+    for value in values:
+        if not value:
+            continue
+        for token in re.split(r'[\W_]+', str(value).lower()):
+            if token and token not in tokens:
+                tokens.append(token[:100])
+    return tokens